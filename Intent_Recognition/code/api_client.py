@@ -1,8 +1,18 @@
 # intent_project/api_client.py
 
-import requests
+import asyncio
+import atexit
 import json
-from typing import Dict
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+import joblib
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class BailianApiClient:
@@ -10,7 +20,11 @@ class BailianApiClient:
     用于与百炼大模型服务进行交互的 API 客户端。
     """
 
-    def __init__(self, api_key: str, api_url: str, app_id_map: Dict[str, str], prompt_map: Dict[str, str]):
+    def __init__(self, api_key: str, api_url: str, app_id_map: Dict[str, str], prompt_map: Dict[str, str],
+                 text_encoder: Optional[Any] = None,
+                 cache_size: int = 1024,
+                 semantic_threshold: float = 0.92,
+                 cache_path: Optional[str] = None):
         """
         初始化 API 客户端。
 
@@ -19,60 +33,127 @@ class BailianApiClient:
             api_url (str): API 请求的 URL。
             app_id_map (Dict[str, str]): 意图到 AppID 的映射字典。
             prompt_map (Dict[str, str]): 意图到系统提示的映射字典。
+            text_encoder (Optional[Any]): 用于语义缓存的文本编码器（需提供 encode 方法），None 则只启用精确缓存
+            cache_size (int): 精确缓存和语义缓存各自的最大条目数
+            semantic_threshold (float): 语义缓存命中所需的最小余弦相似度
+            cache_path (Optional[str]): 缓存持久化文件路径，None 表示不持久化
+
+        Raises:
+            ValueError: 未提供 API Key（如环境变量 BAILIAN_API_KEY 未设置）
         """
+        if not api_key:
+            # 否则请求会带着 "Bearer None" 发出，只能得到难以定位的 401
+            raise ValueError("未提供百炼 API Key，请设置环境变量 BAILIAN_API_KEY（见 Agent.env）")
         self.api_key = api_key
         self.api_url = api_url
         self.app_id_map = app_id_map
         self.prompt_map = prompt_map
 
-    def get_response(self, intent: str, user_query: str) -> str:
-        """
-        根据识别出的意图和用户问题，调用百炼 API 获取回复。
+        # 请求中不随调用变化的部分只构造一次
+        self._base_headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        self._payload_tmpl = {
+            "model": "qwen-turbo",
+            "parameters": {"temperature": 0.7}
+        }
 
-        Args:
-            intent (str): 已确定的用户意图。
-            user_query (str): 用户的原始问题。
+        # 复用的异步会话，在 __aenter__ 或首次异步调用时创建
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # 同步接口使用的持久连接池：复用 TCP/TLS 连接。
+        # 只对连接失败重试（请求尚未到达服务端）；生成接口是非幂等的 POST，读超时或网关 502/503/504 时
+        # 服务端可能已经开始生成，重试会产生重复计费的调用。状态码重试沿用 urllib3 默认的幂等方法集，不包括 POST
+        self._http = requests.Session()
+        self._http.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2,
+                              status_forcelist=[502, 503, 504])
+        ))
+
+        # 响应缓存：精确匹配 (intent, query) + 基于查询向量的语义匹配
+        self.text_encoder = text_encoder
+        self.cache_size = cache_size
+        self.semantic_threshold = semantic_threshold
+        self.cache_path = cache_path
+        self._exact: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._sem_index: Optional[np.ndarray] = None  # shape: (N, D)，已归一化的查询向量
+        self._sem_intents: List[str] = []
+        self._sem_responses: List[str] = []
+
+        if cache_path:
+            self.load_cache(cache_path)
+            atexit.register(self.save_cache, cache_path)
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        """创建带统一超时设置的 aiohttp 会话"""
+        return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def __aenter__(self):
+        if self._session is None or self._session.closed:
+            self._session = self._new_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """关闭复用的异步会话"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _build_request(self, intent: str, user_query: str) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        构造请求头和请求体。
 
         Returns:
-            str: 从 API 获取的文本回复或错误信息。
+            Tuple[Optional[dict], Optional[dict]]: (headers, payload)，找不到 AppID 时均为 None
         """
         system_prompt = self.prompt_map.get(intent, "你是一个智能助手，请回答用户问题。")
         app_id = self.app_id_map.get(intent)
 
         if not app_id:
-            return f"❌ 错误：未找到意图 '{intent}' 对应的 AppID。"
+            return None, None
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}",
-            "X-DashScope-AppId": app_id
-        }
+        headers = {**self._base_headers, "X-DashScope-AppId": app_id}
 
         payload = {
-            "model": "qwen-turbo",
+            **self._payload_tmpl,
             "input": {
                 "messages": [
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_query}
                 ]
-            },
-            "parameters": {"temperature": 0.7}
+            }
         }
 
+        return headers, payload
+
+    @staticmethod
+    def _parse_result(result: dict) -> str:
+        """从 API 返回的 JSON 中提取文本回复"""
+        # 检查是否返回了错误码
+        if result.get("code"):
+            return f"❌ API返回错误: {result.get('message', '未知错误')}"
+
+        # 稳定的获取返回文本的方式
+        return result.get("output", {}).get("text", "抱歉，未能从API获取有效回复。")
+
+    def _request_sync(self, intent: str, user_query: str) -> str:
+        """使用持久化的 requests.Session 发送一次同步请求"""
+        headers, payload = self._build_request(intent, user_query)
+        if headers is None:
+            return f"❌ 错误：未找到意图 '{intent}' 对应的 AppID。"
+
         try:
             print(f"Calling Bailian API for intent: {intent}...")
-            response = requests.post(self.api_url, headers=headers, data=json.dumps(payload), timeout=30)
+            response = self._http.post(self.api_url, headers=headers, json=payload, timeout=30)
             response.raise_for_status()  # 如果请求失败（如4xx或5xx），则抛出异常
 
-            result = response.json()
-            # 稳定的获取返回文本的方式
-            text_response = result.get("output", {}).get("text", "抱歉，未能从API获取有效回复。")
-
-            # 检查是否返回了错误码
-            if result.get("code"):
-                return f"❌ API返回错误: {result.get('message', '未知错误')}"
-
-            return text_response
+            return self._parse_result(response.json())
 
         except requests.exceptions.RequestException as e:
             return f"❌ 网络请求失败: {e}"
@@ -80,3 +161,201 @@ class BailianApiClient:
             return f"❌ 返回格式解析失败: 无法解析JSON。原始返回: {response.text}"
         except Exception as e:
             return f"❌ 未知错误: {e}\n原始返回: {response.text if 'response' in locals() else 'N/A'}"
+
+    async def _request(self, session: aiohttp.ClientSession, intent: str, user_query: str) -> str:
+        """使用给定会话发送一次请求"""
+        headers, payload = self._build_request(intent, user_query)
+        if headers is None:
+            return f"❌ 错误：未找到意图 '{intent}' 对应的 AppID。"
+
+        raw_text = None
+        try:
+            print(f"Calling Bailian API for intent: {intent}...")
+            # 直接传 json=，由 aiohttp 负责序列化
+            async with session.post(self.api_url, json=payload, headers=headers) as response:
+                raw_text = await response.text()
+                response.raise_for_status()  # 如果请求失败（如4xx或5xx），则抛出异常
+                result = json.loads(raw_text)
+
+            return self._parse_result(result)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return f"❌ 网络请求失败: {e}"
+        except json.JSONDecodeError:
+            return f"❌ 返回格式解析失败: 无法解析JSON。原始返回: {raw_text}"
+        except Exception as e:
+            return f"❌ 未知错误: {e}\n原始返回: {raw_text if raw_text is not None else 'N/A'}"
+
+    def _encode_query(self, user_query: str) -> Optional[np.ndarray]:
+        """编码查询文本用于语义缓存，未注入编码器时返回 None"""
+        if self.text_encoder is None:
+            return None
+        emb = np.asarray(self.text_encoder.encode([user_query]), dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(emb)
+        return emb / norm if norm > 0 else emb
+
+    def _cache_lookup(self, intent: str, user_query: str) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        查询响应缓存。
+
+        Returns:
+            Tuple[Optional[str], Optional[np.ndarray]]: (命中的回复, 查询向量)，未命中时回复为 None
+        """
+        cached = self._exact_lookup(intent, user_query)
+        if cached is not None:
+            return cached, None
+        return self._semantic_lookup(intent, user_query, self._encode_query(user_query))
+
+    def _exact_lookup(self, intent: str, user_query: str) -> Optional[str]:
+        """按 (意图, 问题) 精确查找缓存的回复"""
+        key = (intent, user_query)
+        if key in self._exact:
+            self._exact.move_to_end(key)
+            return self._exact[key]
+        return None
+
+    def _semantic_lookup(self, intent: str, user_query: str,
+                         emb: Optional[np.ndarray]) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """用已编码的查询向量查找语义相近的缓存回复，返回 (命中的回复, 查询向量)"""
+        key = (intent, user_query)
+        if emb is not None and self._sem_index is not None and len(self._sem_responses):
+            sims = (self._sem_index @ emb.T).ravel()
+            # 意图不一致的条目不能命中
+            sims[np.asarray(self._sem_intents) != intent] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] > self.semantic_threshold:
+                response = self._sem_responses[best]
+                self._remember_exact(key, response)
+                return response, emb
+
+        return None, emb
+
+    def _remember_exact(self, key: Tuple[str, str], response: str):
+        self._exact[key] = response
+        self._exact.move_to_end(key)
+        while len(self._exact) > self.cache_size:
+            self._exact.popitem(last=False)
+
+    def _cache_store(self, intent: str, user_query: str, response: str, emb: Optional[np.ndarray]):
+        """缓存一次成功的 API 回复，错误信息不缓存"""
+        if response.startswith("❌"):
+            return
+
+        self._remember_exact((intent, user_query), response)
+
+        if emb is None:
+            return
+        if self._sem_index is None:
+            self._sem_index = emb.copy()
+        else:
+            self._sem_index = np.vstack([self._sem_index, emb])
+        self._sem_intents.append(intent)
+        self._sem_responses.append(response)
+
+        # 超出容量时淘汰最早写入的语义条目
+        overflow = len(self._sem_responses) - self.cache_size
+        if overflow > 0:
+            self._sem_index = self._sem_index[overflow:]
+            del self._sem_intents[:overflow]
+            del self._sem_responses[:overflow]
+
+    def clear_cache(self):
+        """清空响应缓存"""
+        self._exact.clear()
+        self._sem_index = None
+        self._sem_intents = []
+        self._sem_responses = []
+
+    def save_cache(self, path: Optional[str] = None):
+        """将响应缓存保存到 joblib 文件"""
+        path = path or self.cache_path
+        if not path:
+            return
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump({
+            "exact": list(self._exact.items()),
+            "sem_index": self._sem_index,
+            "sem_intents": self._sem_intents,
+            "sem_responses": self._sem_responses,
+        }, path)
+
+    def load_cache(self, path: Optional[str] = None) -> bool:
+        """从 joblib 文件加载响应缓存，成功返回 True"""
+        path = path or self.cache_path
+        if not path or not os.path.exists(path):
+            return False
+        try:
+            data = joblib.load(path)
+            self._exact = OrderedDict((tuple(k), v) for k, v in data.get("exact", []))
+            self._sem_index = data.get("sem_index")
+            self._sem_intents = list(data.get("sem_intents", []))
+            self._sem_responses = list(data.get("sem_responses", []))
+            return True
+        except Exception as e:
+            print(f"⚠️  加载响应缓存失败: {e}")
+            self.clear_cache()
+            return False
+
+    async def get_response_async(self, intent: str, user_query: str) -> str:
+        """
+        异步版本的 get_response，复用实例上的 ClientSession。
+
+        Args:
+            intent (str): 已确定的用户意图。
+            user_query (str): 用户的原始问题。
+
+        Returns:
+            str: 从 API 获取的文本回复或错误信息。
+        """
+        cached = self._exact_lookup(intent, user_query)
+        if cached is not None:
+            return cached
+        emb = None
+        if self.text_encoder is not None:
+            # 编码是同步的模型推理，放到线程池中执行，避免阻塞事件循环上的其他请求
+            loop = asyncio.get_running_loop()
+            emb = await loop.run_in_executor(None, self._encode_query, user_query)
+        cached, emb = self._semantic_lookup(intent, user_query, emb)
+        if cached is not None:
+            return cached
+
+        if self._session is None or self._session.closed:
+            self._session = self._new_session()
+        response = await self._request(self._session, intent, user_query)
+        self._cache_store(intent, user_query, response, emb)
+        return response
+
+    async def get_responses_batch(self, pairs: Iterable[Tuple[str, str]]) -> List[str]:
+        """
+        并发发送多个 (intent, user_query) 请求，网络往返相互重叠。
+
+        Args:
+            pairs (Iterable[Tuple[str, str]]): (意图, 用户问题) 列表
+
+        Returns:
+            List[str]: 与输入顺序一致的回复列表
+        """
+        return await asyncio.gather(
+            *(self.get_response_async(intent, user_query) for intent, user_query in pairs)
+        )
+
+    def get_response(self, intent: str, user_query: str) -> str:
+        """
+        根据识别出的意图和用户问题，调用百炼 API 获取回复（同步接口）。
+
+        Args:
+            intent (str): 已确定的用户意图。
+            user_query (str): 用户的原始问题。
+
+        Returns:
+            str: 从 API 获取的文本回复或错误信息。
+        """
+        cached, emb = self._cache_lookup(intent, user_query)
+        if cached is not None:
+            return cached
+
+        response = self._request_sync(intent, user_query)
+        self._cache_store(intent, user_query, response, emb)
+        return response
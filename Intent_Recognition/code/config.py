@@ -1,4 +1,5 @@
 # /config.py
+import os
 
 # --- 模型相关配置 ---
 # SentenceTransformer 模型路径 (这个路径 'code' 文件夹之外，所以我们保持它不变)
@@ -7,12 +8,21 @@ MODEL_PATH = r"D:\Recognition\Model\Qwen3-Embedding-0.6B"
 # 训练好的随机森林分类器模型保存路径 (修改为你的项目路径下的绝对路径)
 CLASSIFIER_MODEL_PATH = "D:/Recognition/code/saved_models/random_forest_classifier.joblib"
 
-# --- 百炼 API 相关配置 ---
-# API 服务地址
-API_URL = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+# 文本向量持久化缓存 (SQLite)，键中包含 MODEL_PATH，更换模型后旧缓存自动失效。
+# 可通过环境变量 INTENT_EMBEDDING_CACHE 指定路径（如容器中的可写卷，或训练与服务进程各用一个文件）；
+# 设为空字符串则只使用内存缓存，不写磁盘
+EMBEDDING_CACHE_PATH = os.getenv("INTENT_EMBEDDING_CACHE", "~/.cache/intent_emb.sqlite") or None
 
-# API 密钥 (强烈建议从环境变量中读取，避免硬编码)
-API_KEY = "sk-93817db303964020bbc79b017be4768b"
+# --- 百炼 API 相关配置 ---
+# API 服务地址 (可通过环境变量 BAILIAN_API_URL 覆盖)
+API_URL = os.getenv(
+    "BAILIAN_API_URL",
+    "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+)
+
+# API 密钥，从环境变量读取 (与 Agent.env 中的 BAILIAN_API_KEY 保持一致)，避免硬编码；
+# 未设置时为 None，BailianApiClient 构造时会直接报错
+API_KEY = os.getenv("BAILIAN_API_KEY")
 
 # 不同意图对应百炼应用的 AppID
 INTENT_TO_APPID = {
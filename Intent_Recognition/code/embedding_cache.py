@@ -0,0 +1,145 @@
+# intent_project/embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    文本向量的持久化缓存。
+    以 SHA-256(模型标识 + 编码参数 + 文本) 为键，把 float32 向量以原始字节存入 SQLite，
+    前面再加一层内存 LRU 存放热点查询。命中时完全跳过 Transformer 前向计算。
+    """
+
+    def __init__(self,
+                 encoder_factory: Callable[[], Any],
+                 model_id: str,
+                 path: Optional[str] = "~/.cache/intent_emb.sqlite",
+                 memory_size: int = 4096):
+        """
+        Args:
+            encoder_factory (Callable[[], Any]): 返回文本编码器的函数，仅在缓存未命中时调用，避免无谓地加载模型
+            model_id (str): 模型标识（如模型路径），写入键中，换模型后旧向量自动失效
+            path (Optional[str]): SQLite 文件路径；None 或空字符串表示只用内存层，不写磁盘
+                （只读或容器化部署）。文件无法创建时同样退化为只用内存层
+            memory_size (int): 内存 LRU 层的最大条目数
+        """
+        self.encoder_factory = encoder_factory
+        self.model_id = model_id
+        self.path = os.path.expanduser(path) if path else None
+        self.memory_size = memory_size
+
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._conn: Optional[sqlite3.Connection] = None
+        if self.path:
+            try:
+                cache_dir = os.path.dirname(self.path)
+                if cache_dir:
+                    os.makedirs(cache_dir, exist_ok=True)
+                # 训练进程和服务进程可能同时使用同一个文件：WAL 模式下读写互不阻塞，写锁冲突时等待而不是立即报错
+                conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, vec BLOB NOT NULL)")
+                conn.commit()
+                self._conn = conn
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️  无法打开向量缓存文件 {self.path}: {e}，只使用内存缓存")
+                self.path = None
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str, namespace: str) -> bytes:
+        return hashlib.sha256(f"{self.model_id}\0{namespace}\0{text}".encode("utf-8")).digest()
+
+    def _remember(self, key: bytes, vec: np.ndarray):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def encode(self, texts: List[str], normalize: bool = True, pooling_strategy: str = 'mean', **kwargs) -> np.ndarray:
+        """
+        与 TextEncoder.encode 接口一致的带缓存编码。
+
+        Args:
+            texts (List[str]): 需要编码的文本列表
+            normalize (bool): 是否L2归一化（参与缓存键）
+            pooling_strategy (str): 池化策略（参与缓存键）
+            **kwargs: 透传给底层 encode 的其他参数（如 batch_size）
+
+        Returns:
+            np.ndarray: 文本向量矩阵，shape为(n_texts, embedding_dim)，float32
+        """
+        namespace = f"{pooling_strategy}:{int(normalize)}"
+        keys = [self._key(text, namespace) for text in texts]
+        vectors: List[Any] = [None] * len(texts)
+        missing = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vec = self._memory.get(key)
+                if vec is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vec
+                    continue
+                row = None
+                if self._conn is not None:
+                    row = self._conn.execute("SELECT vec FROM emb WHERE key=?", (key,)).fetchone()
+                if row is not None:
+                    vec = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, vec)
+                    vectors[i] = vec
+                else:
+                    missing.append(i)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # 同一批中重复的文本只编码一次
+            unique = list(OrderedDict.fromkeys(texts[i] for i in missing))
+            encoded = self.encoder_factory().encode(
+                unique, normalize=normalize, pooling_strategy=pooling_strategy, **kwargs
+            )
+            encoded = np.ascontiguousarray(encoded, dtype=np.float32)
+            by_text = dict(zip(unique, encoded))
+
+            with self._lock:
+                for text in unique:
+                    key = self._key(text, namespace)
+                    if self._conn is not None:
+                        self._conn.execute("INSERT OR REPLACE INTO emb (key, vec) VALUES (?, ?)",
+                                           (key, by_text[text].tobytes()))
+                    self._remember(key, by_text[text])
+                if self._conn is not None:
+                    self._conn.commit()
+
+            for i in missing:
+                vectors[i] = by_text[texts[i]]
+
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def clear(self):
+        """清空内存层和磁盘上的全部缓存"""
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM emb")
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
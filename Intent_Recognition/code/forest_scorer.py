@@ -0,0 +1,105 @@
+# intent_project/forest_scorer.py
+"""
+单样本随机森林打分器。
+把 sklearn 各棵树的节点数组打包成按树填充的连续数组 (SoA)，
+用 Numba 编译的函数在原生代码中遍历全部树并汇总类别概率，绕开 sklearn 每棵树的 Python/Cython 调用开销。
+未安装 numba 时 NUMBA_AVAILABLE 为 False，调用方应回退到 sklearn。
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+class PackedForest(NamedTuple):
+    feature: np.ndarray      # (n_trees, max_nodes) int32，分裂特征下标
+    threshold: np.ndarray    # (n_trees, max_nodes) float64，分裂阈值（与 sklearn 保持同样精度）
+    left: np.ndarray         # (n_trees, max_nodes) int32，左子节点，-1 表示叶子
+    right: np.ndarray        # (n_trees, max_nodes) int32，右子节点
+    leaf_probs: np.ndarray   # (n_trees, max_nodes, n_classes) float32，节点上的类别概率
+
+
+def pack_forest(estimators, n_classes: int) -> PackedForest:
+    """
+    将已训练的决策树列表打包成填充后的连续数组。
+
+    Args:
+        estimators: RandomForestClassifier.estimators_
+        n_classes (int): 类别数
+
+    Returns:
+        PackedForest: 打包后的树结构
+    """
+    n_trees = len(estimators)
+    max_nodes = max(est.tree_.node_count for est in estimators)
+
+    feature = np.zeros((n_trees, max_nodes), dtype=np.int32)
+    threshold = np.zeros((n_trees, max_nodes), dtype=np.float64)
+    left = np.full((n_trees, max_nodes), -1, dtype=np.int32)
+    right = np.full((n_trees, max_nodes), -1, dtype=np.int32)
+    leaf_probs = np.zeros((n_trees, max_nodes, n_classes), dtype=np.float32)
+
+    for t, est in enumerate(estimators):
+        tree = est.tree_
+        n = tree.node_count
+        feature[t, :n] = tree.feature
+        threshold[t, :n] = tree.threshold
+        left[t, :n] = tree.children_left
+        right[t, :n] = tree.children_right
+
+        # 与 DecisionTreeClassifier.predict_proba 一致：按节点样本权重归一化
+        value = tree.value[:, 0, :]
+        totals = value.sum(axis=1, keepdims=True)
+        totals[totals == 0] = 1.0
+        leaf_probs[t, :n] = value / totals
+
+    return PackedForest(feature, threshold, left, right, leaf_probs)
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _score(feature, threshold, left, right, leaf_probs, x, out):
+        n_trees = feature.shape[0]
+        n_classes = leaf_probs.shape[2]
+        # 每棵树写自己的一行，避免并行累加时的数据竞争
+        per_tree = np.empty((n_trees, n_classes), dtype=np.float32)
+
+        for t in prange(n_trees):
+            node = 0
+            while left[t, node] != -1:
+                if x[feature[t, node]] <= threshold[t, node]:
+                    node = left[t, node]
+                else:
+                    node = right[t, node]
+            for c in range(n_classes):
+                per_tree[t, c] = leaf_probs[t, node, c]
+
+        for c in range(n_classes):
+            out[c] = 0.0
+        for t in range(n_trees):
+            for c in range(n_classes):
+                out[c] += per_tree[t, c]
+        for c in range(n_classes):
+            out[c] /= n_trees
+
+
+def score_single(packed: PackedForest, x: np.ndarray) -> np.ndarray:
+    """
+    计算单个样本的类别概率。
+
+    Args:
+        packed (PackedForest): pack_forest 的结果
+        x (np.ndarray): 一维特征向量（已做与训练时相同的预处理）
+
+    Returns:
+        np.ndarray: 类别概率，shape为(n_classes,)，float32
+    """
+    out = np.empty(packed.leaf_probs.shape[2], dtype=np.float32)
+    _score(packed.feature, packed.threshold, packed.left, packed.right, packed.leaf_probs,
+           np.ascontiguousarray(x, dtype=np.float32), out)
+    return out
@@ -1,11 +1,32 @@
 # intent_project/intent_classifier.py
+import asyncio
+import functools
+from typing import List, Optional
+
 import numpy as np
 
 # 从项目内部模块导入
 from Intent_Recognition.code import config
 from Intent_Recognition.code.preprocessing import TextEncoder
+from Intent_Recognition.code.embedding_cache import EmbeddingCache
 from Intent_Recognition.code.model import IntentRecognitionModel
 
+
+@functools.lru_cache(maxsize=1)
+def get_text_encoder() -> TextEncoder:
+    """
+    进程内共享的文本编码器。
+    首次访问时才加载 Qwen3-Embedding 模型，之后所有 IntentClassifier 实例复用同一份权重。
+    """
+    return TextEncoder(config.MODEL_PATH)
+
+
+@functools.lru_cache(maxsize=1)
+def get_embedding_cache() -> EmbeddingCache:
+    """进程内共享的持久化向量缓存，未命中时才会触发编码器加载"""
+    return EmbeddingCache(get_text_encoder, model_id=config.MODEL_PATH, path=config.EMBEDDING_CACHE_PATH)
+
+
 class IntentClassifier:
     """
     意图分类器主类。
@@ -19,7 +40,6 @@ class IntentClassifier:
         Args:
             train_if_not_exist (bool): 如果本地没有找到已训练的模型文件，是否自动进行训练。
         """
-        self.text_encoder = TextEncoder(config.MODEL_PATH)
         self.model = IntentRecognitionModel()
 
         # 尝试加载已训练的模型
@@ -32,6 +52,11 @@ class IntentClassifier:
 
 
 
+    @property
+    def text_encoder(self) -> TextEncoder:
+        """延迟加载的共享文本编码器"""
+        return get_text_encoder()
+
     def predict_intent(self, text: str):
         """
         对输入的文本进行意图预测。
@@ -48,30 +73,120 @@ class IntentClassifier:
                       "top_options": [("校园知识问答", 0.95), ("论文助手", 0.03)]
                   }
         """
-        if not self.model.is_trained:
-            raise RuntimeError("Classifier model is not ready. Please train or load it first.")
-
-        # 1. 编码输入文本
-        vector = self.text_encoder.encode([text])
-
-        # 2. 获取模型预测结果
-        predicted_intent, max_prob, probabilities, classes = self.model.predict(vector)
+        return self.predict_intents([text])[0]
 
-        # 3. 整理返回结果
-        all_probs = dict(zip(classes, probabilities))
-
-        # 获取最可能的N个选项
-        top_indices = np.argsort(probabilities)[-config.TOP_N_OPTIONS:][::-1]
-        top_options = [(classes[i], probabilities[i]) for i in top_indices]
-
-        result = {
-            "best_intent": predicted_intent,
-            "confidence": max_prob,
-            "all_probs": all_probs,
-            "top_options": top_options
-        }
+    def predict_intents(self, texts: List[str]) -> List[dict]:
+        """
+        批量意图预测：一次编码、一次森林推理，摊薄每次调用的固定开销。
 
-        return result
+        Args:
+            texts (List[str]): 用户输入的文本列表。
 
+        Returns:
+            List[dict]: 与输入顺序一致的预测结果，格式同 predict_intent。
+        """
+        if not self.model.is_trained:
+            raise RuntimeError("Classifier model is not ready. Please train or load it first.")
 
+        if not texts:
+            return []
+
+        # 1. 批量编码输入文本（命中持久化缓存的文本不再经过模型）
+        #    TextEncoder.encode 内部已按 token 长度排序分批，这里整批交给缓存即可
+        vectors = get_embedding_cache().encode(texts)
+
+        # 2. 批量获取类别概率
+        probs, _ = self.model.predict_proba(vectors)
+        labels = self.model.class_labels
+
+        # 3. 向量化地选出每行最可能的N个选项（O(K) 部分选择，不做全排序）
+        best_idx = np.argmax(probs, axis=1)
+        n_top = min(config.TOP_N_OPTIONS, probs.shape[1])
+        if n_top == 1:
+            top_idx = best_idx[:, None]
+        else:
+            top_idx = np.argpartition(-probs, n_top - 1, axis=1)[:, :n_top]
+            top_probs = np.take_along_axis(probs, top_idx, axis=1)
+            order = np.argsort(-top_probs, axis=1)
+            top_idx = np.take_along_axis(top_idx, order, axis=1)
+
+        # 一次性转成 Python 列表，逐行构建结果时不再有 numpy 标量的装箱开销
+        results = []
+        for row, best, top in zip(probs.tolist(), best_idx.tolist(), top_idx.tolist()):
+            results.append({
+                "best_intent": labels[best],
+                "confidence": row[best],
+                "all_probs": dict(zip(labels, row)),
+                "top_options": [(labels[i], row[i]) for i in top]
+            })
+
+        return results
+
+
+class IntentBatcher:
+    """
+    异步微批处理器：把并发到达的单条预测请求在短时间窗口内合并为一次 predict_intents 调用。
+    适用于 FastAPI 等异步服务，需在事件循环中使用。
+    """
 
+    def __init__(self, classifier: IntentClassifier, max_batch_size: int = 32, max_wait: float = 0.01):
+        """
+        Args:
+            classifier (IntentClassifier): 已就绪的意图分类器
+            max_batch_size (int): 单批最大请求数
+            max_wait (float): 凑批的最长等待时间（秒）
+        """
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def predict(self, text: str) -> dict:
+        """提交一条文本并等待其所在批次的预测结果"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # 在时间窗口内尽量凑满一批
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.classifier.predict_intents, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """停止后台批处理任务"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
@@ -1,15 +1,18 @@
 import os
 import joblib
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import train_test_split, RandomizedSearchCV, cross_val_score
-from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
 from sklearn.preprocessing import StandardScaler
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Dict, Any, Optional
-from collections import Counter
 import warnings
 
-warnings.filterwarnings('ignore')
+try:
+    import onnxruntime
+except ImportError:  # ONNX 推理为可选加速，缺失时回退到 sklearn
+    onnxruntime = None
+
+from Intent_Recognition.code.forest_scorer import NUMBA_AVAILABLE, pack_forest, score_single
 
 
 class IntentRecognitionModel:
@@ -18,6 +21,9 @@ class IntentRecognitionModel:
     支持超参数优化和全面的模型评估。
     """
 
+    # 批量预测样本数达到该阈值时才启用多线程 predict_proba，小批量下 joblib 调度开销远大于树遍历本身
+    PARALLEL_PREDICT_THRESHOLD = 1024
+
     def __init__(self,
                  n_estimators: int = 50,#森林中的数量。
                  max_depth: Optional[int] = 30,#树的最大深度
@@ -28,7 +34,8 @@ class IntentRecognitionModel:
                  oob_score: bool = True,#是否使用袋外样本估计泛化误差（Out-Of-Bag评分）
                  n_jobs: int = -1,# -1表述使用全部可用核心
                  random_state: int = 42,#随机种子
-                 class_weight: str = 'balanced'):#类别权重策略。设置为'balanced'时，会根据样本分布字典跳转各类的权重，缓解类别不平衡的问题
+                 class_weight: str = 'balanced',#类别权重策略。设置为'balanced'时，会根据样本分布字典跳转各类的权重，缓解类别不平衡的问题
+                 use_scaler: bool = False):#是否做特征标准化。随机森林对单调缩放不敏感，默认关闭以省去推理时的标准化开销
         """
         小于5的不会被分割成一个内部节点，小于2的不会被分割成一个叶节点
 
@@ -47,6 +54,7 @@ class IntentRecognitionModel:
             n_jobs (int): 并行作业数，-1表示使用所有处理器
             random_state (int): 随机种子，确保结果可复现
             class_weight (str): 类别权重策略，'balanced'自动处理类别不平衡
+            use_scaler (bool): 是否在训练和推理时使用 StandardScaler
         """
         self.clf = RandomForestClassifier(
             n_estimators=n_estimators,
@@ -61,14 +69,20 @@ class IntentRecognitionModel:
             class_weight=class_weight
         )
         
-        # 初始化标准化器，用于特征缩放
+        # 初始化标准化器，用于特征缩放（仅在 use_scaler=True 时拟合）
+        self.use_scaler = use_scaler
         self.scaler = StandardScaler()
+        self._mean = None#标准化均值（float32，连续内存），未使用标准化时为None
+        self._inv_scale = None#标准化缩放因子的倒数（float32，连续内存）
         self.is_trained = False#模型是否已训练
         self.accuracy = None#模型准确度
         self.best_params = None#最佳参数字典
         self.class_distribution = None#类别分布字典
         self.feature_importance = None#特征重要性字典
         self.cross_val_scores = None#交叉验证得分
+        self._ort = None#ONNX Runtime 推理会话（标准化器+随机森林融合图），仅在加载到 .onnx 文件时可用
+        self._packed = None#打包后的树结构，供 Numba 单样本打分使用，仅在安装了 numba 时可用
+        self._classes_tuple = ()#字符串形式的类别标签，训练/加载时缓存一次
 
     def analyze_data_distribution(self, y) -> Dict[str, int]:
         """
@@ -80,6 +94,8 @@ class IntentRecognitionModel:
         Returns:
             Dict[str, int]: 类别分布字典
         """
+        from collections import Counter
+
         class_counts = Counter(y)#用counter来统计各意图类别的样本数
         self.class_distribution = dict(class_counts)#输出保存至self.class_distribution
 
@@ -119,6 +135,8 @@ class IntentRecognitionModel:
         Returns:
             Dict[str, Any]: 最佳参数字典
         """
+        from sklearn.model_selection import RandomizedSearchCV
+
         print("\n" + "=" * 50)
         print("开始超参数优化")
         print("=" * 50)
@@ -169,7 +187,8 @@ class IntentRecognitionModel:
 
         return self.best_params
 
-    def train(self, X, y, test_size: float = 0.20, optimize: bool = False, validate: bool = True):
+    def train(self, X, y, test_size: float = 0.20, optimize: bool = False, validate: bool = True,
+              prune_to: Optional[int] = None, prune_val_size: float = 0.15):
         """
         训练模型，支持超参数优化和全面评估
 
@@ -179,9 +198,22 @@ class IntentRecognitionModel:
             test_size (float): 测试集比例
             optimize (bool): 是否进行超参数优化
             validate (bool): 是否进行详细验证评估
+            prune_to (Optional[int]): 训练后只保留的树数量，None表示不剪枝（仅推理部署时建议开启）
+            prune_val_size (float): 剪枝时从训练集中划出的验证集比例，测试集不参与选树
         """
+        # 训练过程中 sklearn 的收敛/类别警告较多，只在训练期间屏蔽，不影响调用方的全局警告设置
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._train(X, y, test_size, optimize, validate, prune_to, prune_val_size)
+
+    def _train(self, X, y, test_size, optimize, validate, prune_to, prune_val_size):
+        from sklearn.model_selection import train_test_split
+
         print("开始模型训练...")
 
+        # 随机森林内部按 float32 处理特征，提前转换避免重复拷贝
+        X = np.asarray(X, dtype=np.float32)
+
         # 分析数据分布
         self.analyze_data_distribution(y)
 
@@ -197,10 +229,18 @@ class IntentRecognitionModel:
         print(f"训练集: {len(X_train)} 样本")
         print(f"测试集: {len(X_test)} 样本")
 
-        # 特征标准化（虽然随机森林对此不敏感，但可能有帮助）
-        print("\n进行特征标准化...")
-        X_train_scaled = self.scaler.fit_transform(X_train)
-        X_test_scaled = self.scaler.transform(X_test)
+        # 特征标准化（随机森林对此不敏感，默认跳过）
+        if self.use_scaler:
+            print("\n进行特征标准化...")
+            X_train_scaled = self.scaler.fit_transform(X_train)
+            self.scaler.mean_ = self.scaler.mean_.astype(np.float32)
+            self.scaler.scale_ = self.scaler.scale_.astype(np.float32)
+            X_test_scaled = self.scaler.transform(X_test)
+        else:
+            print("\n跳过特征标准化（随机森林对单调缩放不敏感）")
+            self.scaler = StandardScaler()
+            X_train_scaled, X_test_scaled = X_train, X_test
+        self._prepare_scaler_stats()
 
         # 超参数优化（可选）
         if optimize:
@@ -209,21 +249,89 @@ class IntentRecognitionModel:
         else:
             print("\n使用默认参数训练...")
 
+        # 剪枝需要独立的验证集来选树，避免占用测试集导致评估结果偏高
+        if prune_to is not None:
+            X_train_scaled, X_val_scaled, y_train, y_val = train_test_split(
+                X_train_scaled, y_train,
+                test_size=prune_val_size,
+                random_state=42,
+                stratify=y_train
+            )
+
         # 训练模型
         print("\n训练随机森林模型...")
         self.clf.fit(X_train_scaled, y_train)
         self.is_trained = True
 
+        if prune_to is not None:
+            self.prune_estimators(X_val_scaled, y_val, prune_to)
+        self._ort = None  # 重新训练后旧的 ONNX 图已失效
+        self._pack_forest()
+        self._cache_classes()
+
         # 模型验证
         if validate:
             self._comprehensive_evaluation(X_train_scaled, X_test_scaled, y_train, y_test)
 
+        # 训练用满所有核心，推理默认单线程
+        self.clf.n_jobs = 1
+
         print("\n✅ 模型训练完成！")
 
+    def prune_estimators(self, X_val, y_val, k: int = 20) -> list:
+        """
+        贪心前向选树：每一步加入使子森林验证集准确率最高的那棵树，直到保留 k 棵。
+        推理时遍历的树更少，保存的模型也更小。
+
+        Args:
+            X_val: 已做过与训练集相同预处理的验证特征
+            y_val: 验证标签
+            k (int): 保留的树数量
+
+        Returns:
+            list: 被保留的树在原 estimators_ 中的下标
+        """
+        estimators = self.clf.estimators_
+        if k >= len(estimators):
+            return list(range(len(estimators)))
+
+        X_val = np.ascontiguousarray(X_val, dtype=np.float32)
+        y_idx = np.searchsorted(self.clf.classes_, np.asarray(y_val))
+
+        # 每棵树在验证集上的概率只算一次: (n_trees, n_val, n_classes)
+        tree_probs = np.stack([tree.predict_proba(X_val, check_input=False) for tree in estimators])
+
+        selected = []
+        remaining = list(range(len(estimators)))
+        summed = np.zeros(tree_probs.shape[1:], dtype=tree_probs.dtype)
+        for _ in range(k):
+            # 候选子森林（未归一化的概率和即可比较 argmax）
+            candidates = summed[None, :, :] + tree_probs[remaining]
+            accs = (np.argmax(candidates, axis=2) == y_idx[None, :]).mean(axis=1)
+            best = remaining.pop(int(np.argmax(accs)))
+            selected.append(best)
+            summed += tree_probs[best]
+
+        full_acc = float((np.argmax(tree_probs.sum(axis=0), axis=1) == y_idx).mean())
+        pruned_acc = float((np.argmax(summed, axis=1) == y_idx).mean())
+
+        self.clf.estimators_ = [estimators[i] for i in selected]
+        self.clf.n_estimators = k
+        self._ort = None
+        self._pack_forest()
+
+        print(f"\n✂️  随机森林剪枝: {len(estimators)} -> {k} 棵树")
+        print(f"验证集准确率: {full_acc:.4f} -> {pruned_acc:.4f}")
+
+        return selected
+
     def _comprehensive_evaluation(self, X_train, X_test, y_train, y_test):
         """
         全面的模型性能评估
         """
+        from sklearn.model_selection import cross_val_score
+        from sklearn.metrics import classification_report, confusion_matrix
+
         print("\n" + "=" * 50)
         print("模型性能评估")
         print("=" * 50)
@@ -311,18 +419,135 @@ class IntentRecognitionModel:
         if vector.ndim == 1:
             vector = vector.reshape(1, -1)
 
-        # 特征标准化
-        vector_scaled = self.scaler.transform(vector)
-
-        # 预测概率
-        probabilities = self.clf.predict_proba(vector_scaled)[0]
+        # 预测概率：单样本由 _predict_proba 交给 Numba 打分器
+        probabilities = self._predict_proba(vector)[0]
         max_prob_index = np.argmax(probabilities)
         max_prob = probabilities[max_prob_index]
         predicted_intent = self.clf.classes_[max_prob_index]
 
         return predicted_intent, max_prob, probabilities, self.clf.classes_
 
-    def predict_batch(self, vectors: np.ndarray, confidence_threshold: float = 0.5) -> list:
+    def predict_proba(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量计算类别概率（一次标准化 + 一次 predict_proba）
+
+        Args:
+            vectors (np.ndarray): 文本向量矩阵，shape为(n_samples, n_features)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 概率矩阵 (n_samples, n_classes)、类别标签
+        """
+        if not self.is_trained:
+            raise RuntimeError("模型尚未训练。请先调用 train() 或 load_model() 方法。")
+
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+
+        return self._predict_proba(vectors), self.clf.classes_
+
+    def _predict_proba(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        对原始向量计算类别概率：
+        - 单样本且已打包森林（安装了 numba）：Numba 打分器。线上意图识别每次只有一条文本，
+          原生代码直接遍历全部树，比 ONNX Runtime 每次 run 的会话调度开销和 sklearn 逐棵树的调用都小
+        - 多样本：优先走 ONNX Runtime 融合图（批内并行），否则使用 sklearn
+
+        Args:
+            vectors (np.ndarray): 未标准化的二维向量矩阵
+
+        Returns:
+            np.ndarray: 概率矩阵 (n_samples, n_classes)
+        """
+        # 全程使用 float32：树的分裂阈值本身就是 float32，既省一半内存带宽也免去 sklearn 内部的类型转换
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        if len(vectors) == 1 and self._packed is not None:
+            return score_single(self._packed, self._scale(vectors)[0])[None, :]
+
+        if self._ort is not None:
+            return self._ort.run(
+                [self._ort_prob_name],
+                {self._ort_input_name: vectors}
+            )[0]
+
+        return self.clf.predict_proba(self._scale(vectors))
+
+    def _cache_classes(self):
+        """缓存字符串类别标签，避免每次构建结果时逐个 str() 转换"""
+        self._classes_tuple = tuple(map(str, self.clf.classes_))
+
+    @property
+    def class_labels(self) -> Tuple[str, ...]:
+        """与概率列顺序一致的类别标签"""
+        return self._classes_tuple
+
+    def _pack_forest(self):
+        """把随机森林打包成 Numba 打分器所需的连续数组，未安装 numba 时跳过"""
+        self._packed = None
+        if not NUMBA_AVAILABLE or not hasattr(self.clf, 'estimators_'):
+            return
+        try:
+            self._packed = pack_forest(self.clf.estimators_, len(self.clf.classes_))
+        except Exception as e:
+            print(f"⚠️  打包随机森林失败，单样本预测回退到 sklearn: {e}")
+
+    def _predict_proba_lowmem(self, vectors: np.ndarray, n_threads: int = 1) -> np.ndarray:
+        """
+        逐棵树把概率累加到预分配的输出数组中，峰值内存为 O(n_samples·n_classes)，
+        而不是 O(n_trees·n_samples·n_classes)。
+
+        Args:
+            vectors (np.ndarray): 未标准化的二维向量矩阵
+            n_threads (int): 并行线程数；树的 predict_proba 在 Cython 中释放 GIL，多线程可真正并行
+
+        Returns:
+            np.ndarray: 概率矩阵 (n_samples, n_classes)，float32
+        """
+        X = np.ascontiguousarray(self._scale(np.ascontiguousarray(vectors, dtype=np.float32)), dtype=np.float32)
+        estimators = self.clf.estimators_
+        n_classes = len(self.clf.classes_)
+
+        def _accumulate(trees):
+            out = np.zeros((X.shape[0], n_classes), dtype=np.float32)
+            for tree in trees:
+                # X 已是连续 float32，跳过每棵树重复的输入校验
+                out += tree.predict_proba(X, check_input=False)
+            return out
+
+        n_threads = max(1, min(n_threads, len(estimators)))
+        if n_threads == 1:
+            out = _accumulate(estimators)
+        else:
+            groups = [estimators[i::n_threads] for i in range(n_threads)]
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                parts = list(executor.map(_accumulate, groups))
+            out = parts[0]
+            for part in parts[1:]:
+                out += part
+
+        out /= len(estimators)
+        return out
+
+    def _prepare_scaler_stats(self):
+        """预计算标准化所需的均值和缩放倒数，使推理时绕开 sklearn 的 transform 包装"""
+        if self.use_scaler and hasattr(self.scaler, 'mean_'):
+            self._mean = np.ascontiguousarray(self.scaler.mean_, dtype=np.float32)
+            self._inv_scale = np.ascontiguousarray(1.0 / self.scaler.scale_, dtype=np.float32)
+        else:
+            self._mean = None
+            self._inv_scale = None
+
+    def _scale(self, vectors: np.ndarray) -> np.ndarray:
+        """对向量做 (x - mean) / scale；未拟合标准化器时原样返回"""
+        if self._mean is None:
+            return vectors
+
+        # 一次分配输出缓冲区，乘法原地完成
+        out = np.subtract(vectors, self._mean, dtype=np.float32)
+        np.multiply(out, self._inv_scale, out=out)
+        return out
+
+    def predict_batch(self, vectors: np.ndarray, confidence_threshold: float = 0.5) -> 'BatchPrediction':
         """
         批量预测，支持置信度阈值
 
@@ -331,42 +556,45 @@ class IntentRecognitionModel:
             confidence_threshold (float): 置信度阈值，低于此值的预测会被标记
 
         Returns:
-            list: 预测结果列表，每个元素包含预测信息
+            BatchPrediction: 列式结果，包含 predicted_intent / confidence / low_confidence /
+                all_probabilities / classes 五个数组及字符串标签 class_labels，需要逐条字典时调用 .row(i)
         """
         if not self.is_trained:
             raise RuntimeError("模型尚未训练。请先调用 train() 或 load_model() 方法。")
 
-        # 特征标准化
-        vectors_scaled = self.scaler.transform(vectors)
-
-        # 批量预测
-        probabilities = self.clf.predict_proba(vectors_scaled)
-        predicted_classes = self.clf.predict(vectors_scaled)
-
-        results = []
-        for i, (pred_class, probs) in enumerate(zip(predicted_classes, probabilities)):
-            max_prob = np.max(probs)
-
-            # 构建结果字典
-            result = {
-                'predicted_intent': pred_class,
-                'confidence': float(max_prob),
-                'low_confidence': max_prob < confidence_threshold,
-                'all_probabilities': {
-                    str(cls): float(prob)
-                    for cls, prob in zip(self.clf.classes_, probs)
-                }
-            }
-            results.append(result)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
 
-        return results
+        # 批量预测（随机森林的 predict 即概率最大的类别）
+        if self._ort is not None:
+            probabilities = self._predict_proba(vectors)
+        else:
+            n_threads = os.cpu_count() if len(vectors) >= self.PARALLEL_PREDICT_THRESHOLD else 1
+            probabilities = self._predict_proba_lowmem(vectors, n_threads=n_threads or 1)
+        max_indices = np.argmax(probabilities, axis=1)
+        max_probs = probabilities[np.arange(len(max_indices)), max_indices]
+
+        return BatchPrediction(
+            predicted_intent=self.clf.classes_[max_indices],
+            confidence=max_probs,
+            low_confidence=max_probs < confidence_threshold,
+            all_probabilities=probabilities,
+            classes=self.clf.classes_,
+            class_labels=self._classes_tuple
+        )
 
-    def save_model(self, path: str):
+    # 体积较大的评估数组单独存为 .npy，加载时按需内存映射
+    _ARRAY_FIELDS = ("feature_importance", "cross_val_scores")
+
+    def save_model(self, path: str, compress: Optional[Tuple[str, int]] = None):
         """
         保存完整的模型信息到文件
 
         Args:
             path (str): 模型保存路径
+            compress (Optional[Tuple[str, int]]): joblib 压缩方式，如 ('lz4', 3)。
+                默认不压缩，这样 load_model 可以用 mmap_mode='r' 直接映射数组；
+                压缩后体积更小，但加载时必须完整解压。未安装 lz4 时自动改用 zlib
         """
         if not self.is_trained:
             raise RuntimeError("无法保存未训练的模型。")
@@ -383,16 +611,104 @@ class IntentRecognitionModel:
             "accuracy": self.accuracy,
             "best_params": self.best_params,
             "class_distribution": self.class_distribution,
-            "feature_importance": self.feature_importance,
-            "cross_val_scores": self.cross_val_scores,
             "model_params": self.clf.get_params(),
-            "version": "2.0",
-            "n_features": self.scaler.n_features_in_ if hasattr(self.scaler, 'n_features_in_') else None
+            "use_scaler": self.use_scaler,
+            "version": "2.1",
+            "n_features": getattr(self.clf, 'n_features_in_', None),
+            "external_arrays": [],
         }
 
-        joblib.dump(model_data, path)
+        for field in self._ARRAY_FIELDS:
+            value = getattr(self, field)
+            array_path = self._array_path(path, field)
+            if value is not None:
+                np.save(array_path, np.asarray(value))
+                model_data["external_arrays"].append(field)
+            elif os.path.exists(array_path):
+                os.remove(array_path)  # 清理上一次保存留下的旧数组
+
+        if compress is not None and compress[0] == 'lz4':
+            try:
+                import lz4  # noqa: F401
+            except ImportError:
+                compress = ('zlib', compress[1])
+
+        joblib.dump(model_data, path, compress=compress or 0)
+        self._export_onnx(path)
         print("✅ 模型保存成功！")
 
+    @staticmethod
+    def _array_path(path: str, field: str) -> str:
+        """与 joblib 模型文件同名的 .npy 数组路径"""
+        suffix = {"feature_importance": "fi", "cross_val_scores": "cv"}[field]
+        return f"{path}.{suffix}.npy"
+
+    @staticmethod
+    def _onnx_path(path: str) -> str:
+        """与 joblib 模型文件同名的 ONNX 文件路径"""
+        return os.path.splitext(path)[0] + ".onnx"
+
+    def _export_onnx(self, path: str):
+        """
+        将标准化器和随机森林融合为一个 ONNX 图保存在 joblib 文件旁边，供推理使用。
+        joblib 文件仍然保留，用于再训练。
+        先删除上一次保存留下的 .onnx 文件：任何一步跳过或失败时都不能让 load_model 用旧森林的 ONNX 图推理；
+        新文件先写入临时文件再原子替换，导出中途失败不会留下残缺文件
+        """
+        onnx_path = self._onnx_path(path)
+        if os.path.exists(onnx_path):
+            os.remove(onnx_path)
+
+        try:
+            from skl2onnx import convert_sklearn
+            from skl2onnx.common.data_types import FloatTensorType
+            from sklearn.pipeline import Pipeline
+        except ImportError:
+            print("⚠️  未安装 skl2onnx，跳过 ONNX 导出")
+            return
+
+        n_features = getattr(self.clf, 'n_features_in_', None)
+        if n_features is None:
+            print("⚠️  缺少特征维度信息，跳过 ONNX 导出")
+            return
+
+        try:
+            steps = [("clf", self.clf)]
+            if self._mean is not None:
+                steps.insert(0, ("scaler", self.scaler))
+            pipeline = Pipeline(steps)
+            onnx_model = convert_sklearn(
+                pipeline,
+                initial_types=[("X", FloatTensorType([None, n_features]))],
+                options={id(self.clf): {"zipmap": False}}  # 概率以矩阵而非字典列表输出
+            )
+            tmp_path = onnx_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(onnx_model.SerializeToString())
+            os.replace(tmp_path, onnx_path)
+            print(f"✅ ONNX 推理模型已导出: {onnx_path}")
+        except Exception as e:
+            print(f"⚠️  ONNX 导出失败: {e}")
+            if os.path.exists(onnx_path + ".tmp"):
+                os.remove(onnx_path + ".tmp")
+
+    def _load_onnx(self, path: str):
+        """若存在同名 .onnx 文件且安装了 onnxruntime，则创建推理会话"""
+        self._ort = None
+        onnx_path = self._onnx_path(path)
+        if onnxruntime is None or not os.path.exists(onnx_path):
+            return
+
+        try:
+            session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+            outputs = [o.name for o in session.get_outputs()]
+            self._ort_input_name = session.get_inputs()[0].name
+            self._ort_prob_name = "probabilities" if "probabilities" in outputs else outputs[-1]
+            self._ort = session
+            print(f"使用 ONNX Runtime 推理: {onnx_path}")
+        except Exception as e:
+            print(f"⚠️  加载 ONNX 模型失败，回退到 sklearn: {e}")
+
     def load_model(self, path: str) -> bool:
         """
         从文件加载预训练模型
@@ -410,17 +726,27 @@ class IntentRecognitionModel:
         print(f"从 {path} 加载模型...")
 
         try:
-            data = joblib.load(path)
+            # 未压缩的模型文件中的 numpy 数组以只读内存映射方式加载，多个进程共享页缓存；
+            # 压缩文件 joblib 会忽略 mmap_mode 并正常解压
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                data = joblib.load(path, mmap_mode='r')
 
             if isinstance(data, dict):
                 # 新版本格式 - 完整数据
                 self.clf = data["model"]
                 self.scaler = data.get("scaler", StandardScaler())
+                # 旧版本模型未记录该字段，按标准化器是否已拟合判断
+                self.use_scaler = data.get("use_scaler", hasattr(self.scaler, 'mean_'))
                 self.accuracy = data.get("accuracy", None)
                 self.best_params = data.get("best_params", None)
                 self.class_distribution = data.get("class_distribution", None)
                 self.feature_importance = data.get("feature_importance", None)
                 self.cross_val_scores = data.get("cross_val_scores", None)
+                for field in data.get("external_arrays", []):
+                    array_path = self._array_path(path, field)
+                    if os.path.exists(array_path):
+                        setattr(self, field, np.load(array_path, mmap_mode='r'))
 
                 # 显示版本信息
                 version = data.get("version", "1.0")
@@ -431,11 +757,17 @@ class IntentRecognitionModel:
                 print("⚠️  检测到旧版本模型格式")
                 self.clf = data
                 self.scaler = StandardScaler()
+                self.use_scaler = False
                 print("警告: 缺少预处理器，可能影响预测准确性")
 
             # 验证模型有效性
             if hasattr(self.clf, 'predict_proba') and hasattr(self.clf, 'classes_'):
                 self.is_trained = True
+                self.clf.n_jobs = 1  # 推理默认单线程，避免每次 predict_proba 的 joblib 调度开销
+                self._prepare_scaler_stats()
+                self._pack_forest()
+                self._cache_classes()
+                self._load_onnx(path)
 
                 # 显示模型信息
                 accuracy_info = f"准确率: {self.accuracy:.4f}" if self.accuracy else "准确率未知"
@@ -475,7 +807,8 @@ class IntentRecognitionModel:
             "class_distribution": self.class_distribution,
             "n_classes": len(self.clf.classes_),
             "classes": list(self.clf.classes_),
-            "n_features": getattr(self.scaler, 'n_features_in_', None)
+            "n_features": getattr(self.clf, 'n_features_in_', None),
+            "use_scaler": self.use_scaler
         }
 
         # 添加性能信息
@@ -523,4 +856,28 @@ class IntentRecognitionModel:
         key_params = ['n_estimators', 'max_depth', 'min_samples_split', 'min_samples_leaf']
         for param in key_params:
             if param in info['model_params']:
-                print(f"  {param}: {info['model_params'][param]}")
\ No newline at end of file
+                print(f"  {param}: {info['model_params'][param]}")
+
+
+class BatchPrediction(dict):
+    """
+    predict_batch 的列式返回结果。
+    各字段均为连续数组，避免为每个样本构建字典；需要兼容旧的逐条格式时使用 row(i)。
+    """
+
+    @property
+    def n_samples(self) -> int:
+        return len(self['confidence'])
+
+    def row(self, i: int) -> Dict[str, Any]:
+        """按需构建第 i 个样本的结果字典（旧版 predict_batch 的元素格式）"""
+        return {
+            'predicted_intent': self['predicted_intent'][i],
+            'confidence': float(self['confidence'][i]),
+            'low_confidence': bool(self['low_confidence'][i]),
+            'all_probabilities': dict(zip(self['class_labels'], self['all_probabilities'][i].tolist()))
+        }
+
+    def rows(self) -> list:
+        """构建全部样本的结果字典列表"""
+        return [self.row(i) for i in range(self.n_samples)]
@@ -1,5 +1,9 @@
 #=====================这是接受用户信息，获取回答的主函数===================
 import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 from Intent_Recognition.code.intent_classifier import IntentClassifier
 from RAGlibrary import RAG_psychology, RAG_fitness, RAG_compus, RAG_paper
@@ -42,7 +46,7 @@ class InteractiveAgent:
             self.classifier = IntentClassifier()
             print("意图分类器初始化成功")
 
-            # 初始化 RAG 智能体（延迟初始化以提高启动速度）
+            # 初始化 RAG 智能体：后台线程并行构建，首轮对话时通常已就绪
             self.rag_agents = {}
             self.agent_classes = {
                 "心理助手": RAG_psychology,
@@ -50,6 +54,12 @@ class InteractiveAgent:
                 "校园知识问答": RAG_compus,
                 "论文助手": RAG_paper
             }
+            self._rag_futures = {}
+            init_pool = ThreadPoolExecutor(max_workers=len(self.agent_classes), thread_name_prefix="rag-init")
+            for name, cls in self.agent_classes.items():
+                self._rag_futures[name] = init_pool.submit(self._build_rag_agent, name, cls)
+            init_pool.shutdown(wait=False)
+            threading.Thread(target=self._report_rag_init, daemon=True).start()
             
             # 意图到头像的映射关系
             self.intent_avatar_mapping = {
@@ -66,19 +76,38 @@ class InteractiveAgent:
             print(f"初始化失败: {e}")
             raise
 
+    @staticmethod
+    def _build_rag_agent(intent, agent_class):
+        """构建单个RAG智能体，失败时返回 None，不影响其他智能体"""
+        try:
+            return agent_class()
+        except Exception as e:
+            print(f"{intent} RAG智能体初始化失败: {e}")
+            return None
+
+    def _report_rag_init(self):
+        """所有后台初始化结束后输出一次汇总"""
+        wait(list(self._rag_futures.values()))
+        ready = [name for name, future in self._rag_futures.items() if future.result() is not None]
+        failed = [name for name in self._rag_futures if name not in ready]
+        print(f"RAG智能体初始化完成: {len(ready)}/{len(self._rag_futures)} 个就绪"
+              + (f"，失败: {', '.join(failed)}" if failed else ""))
+
     def get_rag_agent(self, intent):
-        """延迟初始化RAG智能体"""
+        """获取RAG智能体：等待后台初始化结果，失败的智能体在此重试一次"""
         if intent not in self.rag_agents:
-            if intent in self.agent_classes:
+            if intent not in self.agent_classes:
+                return None
+
+            future = self._rag_futures.get(intent)
+            agent = future.result() if future is not None else None
+            if agent is None:
                 print(f"🔧 正在初始化 {intent} RAG智能体...")
-                try:
-                    self.rag_agents[intent] = self.agent_classes[intent]()
-                    print(f"{intent} RAG智能体初始化成功")
-                except Exception as e:
-                    print(f"{intent} RAG智能体初始化失败: {e}")
+                agent = self._build_rag_agent(intent, self.agent_classes[intent])
+                if agent is None:
                     return None
-            else:
-                return None
+                print(f"{intent} RAG智能体初始化成功")
+            self.rag_agents[intent] = agent
 
         return self.rag_agents.get(intent)
 
@@ -146,10 +175,7 @@ class InteractiveAgent:
                     print(f" {intent} 正在思考")
                     print(" 流式回答：", end="", flush=True)
 
-                    full_response = ""
-                    for delta in rag_agent.call_RAG_stream(user_input):
-                        print(delta, end="", flush=True)
-                        full_response += delta
+                    full_response = self._stream_to_stdout(rag_agent.call_RAG_stream(user_input))
                     print("\n")  # 换行
 
                 else:
@@ -160,6 +186,44 @@ class InteractiveAgent:
             except Exception as e:
                 print(f"调用 {intent} RAG智能体失败：{e}\n")
 
+    @staticmethod
+    def _stream_to_stdout(deltas, buffer_size=8192, flush_interval=0.05):
+        """
+        把流式增量写到标准输出并返回完整回答。
+        增量先攒进字节缓冲区，遇到换行、缓冲区满或距上次刷新超过 flush_interval 秒时才写出，
+        避免每个 token 都 print(flush=True) 带来的加锁和系统调用开销。
+        """
+        stream = getattr(sys.stdout, "buffer", None)
+        if stream is None:  # 标准输出被替换成没有底层缓冲区的对象时，退回逐条 print
+            parts = []
+            for delta in deltas:
+                print(delta, end="", flush=True)
+                parts.append(delta)
+            return "".join(parts)
+
+        sys.stdout.flush()  # 先把文本层里已有的输出写出去，保证顺序
+        write, flush = stream.write, stream.flush
+        pending = bytearray()
+        parts = []
+        last_flush = time.monotonic()
+
+        for delta in deltas:
+            parts.append(delta)
+            chunk = delta.encode("utf-8")
+            pending += chunk
+            now = time.monotonic()
+            if len(pending) >= buffer_size or b"\n" in chunk or now - last_flush > flush_interval:
+                write(pending)
+                flush()
+                pending.clear()
+                last_flush = now
+
+        if pending:
+            write(pending)
+            flush()
+
+        return "".join(parts)
+
     def predict_intent_only(self, user_input):
         """仅进行意图识别，返回意图和对应头像
         
@@ -1,9 +1,210 @@
-from dashscope import Application
 from http import HTTPStatus
+from types import SimpleNamespace
+import asyncio
+import json
 import os
+import threading
+import time
+import httpx
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 百炼智能体应用的 REST 接口，直接请求该地址，不经过 dashscope SDK
+DASHSCOPE_APP_URL = "https://dashscope.aliyuncs.com/api/v1/apps/{app_id}/completion"
+DASHSCOPE_HOST = "https://dashscope.aliyuncs.com/"
+KEEPALIVE_EXPIRY = 30.0
+
+# 进程内共享的同步连接池：复用 TCP/TLS 连接，不再每次调用都重新握手
+_HTTP = httpx.Client(
+    http2=HTTP2_AVAILABLE,
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=KEEPALIVE_EXPIRY),
+    timeout=httpx.Timeout(300.0, connect=10.0)
+)
+_last_request = 0.0  # 最近一次经过连接池的请求时间（monotonic）
+_warming = threading.Lock()
+
+
+def _touch():
+    global _last_request
+    _last_request = time.monotonic()
+
+
+def _warm_connection():
+    try:
+        _HTTP.head(DASHSCOPE_HOST, timeout=5.0)
+    except httpx.HTTPError:
+        pass  # 预热失败不影响正式请求，届时再建立连接
+    finally:
+        _warming.release()
+
+
+def warm_connection():
+    """
+    在后台线程预先建立到百炼服务的 TCP/TLS 连接。
+    连接池里的空闲连接超过 keepalive_expiry 会被丢弃，因此只在连接可能已失效时才发起；
+    调用方在编码查询、检索的同时调用，握手与本地计算重叠，正式请求直接复用连接
+    """
+    if time.monotonic() - _last_request < KEEPALIVE_EXPIRY - 1.0:
+        return
+    if not _warming.acquire(blocking=False):
+        return  # 已有预热在进行
+    _touch()
+    threading.Thread(target=_warm_connection, daemon=True).start()
+
+
+def new_async_client() -> httpx.AsyncClient:
+    """创建用于并发调用智能体应用的异步客户端，连接在同一批请求间复用"""
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=120
+    )
+
+
+_ASYNC_HTTP = None  # (事件循环, 客户端)：异步客户端与创建它的事件循环绑定
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """返回当前事件循环共享的异步客户端（流式接口使用，连接在请求间复用）"""
+    global _ASYNC_HTTP
+    loop = asyncio.get_running_loop()
+    if _ASYNC_HTTP is None or _ASYNC_HTTP[0] is not loop or _ASYNC_HTTP[1].is_closed:
+        _ASYNC_HTTP = (loop, new_async_client())
+    return _ASYNC_HTTP[1]
+
+
+def _escape_json(text: str) -> bytes:
+    """转义为 JSON 字符串内容（不含两侧引号），非 ASCII 字符原样保留为 UTF-8"""
+    return json.encoder.encode_basestring(text)[1:-1].encode("utf-8")
+
+
+def prompt_prefix_json(static_prefix: str) -> bytes:
+    """预先序列化请求体中提示词之前的部分和提示词的静态前缀，每个智能体只做一次"""
+    return b'{"input":{"prompt":"' + _escape_json(static_prefix)
+
+
+def _request_body(prefix_json: bytes, dynamic: str, session_id: str, incremental_output=False) -> bytes:
+    """拼接请求体：预先序列化的静态部分 + 转义后的动态部分，不再对整个提示词重复 json.dumps"""
+    return b"".join((
+        prefix_json,
+        _escape_json(dynamic),
+        b'","session_id":', json.dumps(session_id).encode("utf-8"),
+        b'},"parameters":', b'{"incremental_output":true}' if incremental_output else b'{}',
+        b',"debug":{}}'
+    ))
+
+
+def _app_request(api_key, app_id, stream=False):
+    """构造智能体应用请求的地址和请求头（请求体由 _request_body 生成）"""
+    url = DASHSCOPE_APP_URL.format(app_id=app_id)
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    if stream:
+        headers["X-DashScope-SSE"] = "enable"
+    return url, headers
+
+
+def _to_response(status_code, data):
+    """把接口返回的 JSON 包装成与 dashscope SDK 响应相同的属性访问形式"""
+    return SimpleNamespace(
+        status_code=status_code,
+        request_id=data.get("request_id"),
+        code=data.get("code"),
+        message=data.get("message"),
+        output=SimpleNamespace(text=(data.get("output") or {}).get("text", ""))
+    )
+
+
+def _parse_json(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return {"message": text}
+
+
+def _parse_sse_line(line, status):
+    """
+    解析一行 SSE 数据
+
+    Returns:
+        (状态码, 响应对象或 None)：状态行只更新状态码，数据行产出响应对象
+    """
+    if line.startswith(":HTTP_STATUS/"):
+        return int(line[len(":HTTP_STATUS/"):]), None
+    if line.startswith("data:"):
+        return status, _to_response(status, _parse_json(line[5:]))
+    return status, None
+
+
+def _iter_sse(api_key, app_id, body):
+    """流式请求，逐个产出 SSE 事件对应的响应对象（请求体需开启 incremental_output，每个事件只含新增文本）"""
+    url, headers = _app_request(api_key, app_id, stream=True)
+
+    _touch()
+    with _HTTP.stream("POST", url, headers=headers, content=body) as resp:
+        if resp.status_code != HTTPStatus.OK:
+            yield _to_response(resp.status_code, _parse_json(resp.read().decode("utf-8", "replace")))
+            return
+
+        status = resp.status_code
+        for line in resp.iter_lines():
+            status, response = _parse_sse_line(line, status)
+            if response is not None:
+                yield response
+
+
+async def _aiter_sse(client, api_key, app_id, body):
+    """_iter_sse 的异步版本"""
+    url, headers = _app_request(api_key, app_id, stream=True)
+
+    async with client.stream("POST", url, headers=headers, content=body) as resp:
+        if resp.status_code != HTTPStatus.OK:
+            body = await resp.aread()
+            yield _to_response(resp.status_code, _parse_json(body.decode("utf-8", "replace")))
+            return
+
+        status = resp.status_code
+        async for line in resp.aiter_lines():
+            status, response = _parse_sse_line(line, status)
+            if response is not None:
+                yield response
+
+
+def _print_stream_error(response):
+    print(f'Request id: {response.request_id}')
+    print(f'Status code: {response.status_code}')
+    print(f'Error code: {response.code}')
+    print(f'Error message: {response.message}')
+
+
+def _dashscope_call(api_key, app_id, body, stream=False):
+    """
+    调用百炼智能体应用（代替 SDK 的应用调用接口），请求经过共享连接池
+
+    Args:
+        body (bytes): _request_body 生成的请求体
+
+    Returns:
+        stream=False 时返回单个响应对象，stream=True 时返回响应对象的生成器
+    """
+    if stream:
+        return _iter_sse(api_key, app_id, body)
+
+    url, headers = _app_request(api_key, app_id)
+    _touch()
+    resp = _HTTP.post(url, headers=headers, content=body)
+    return _to_response(resp.status_code, _parse_json(resp.text))
 
 
 class LLM_model:
+    """大模型调用封装。实例在 RAG 之间共享并被并发调用：构造后只读，不保存任何单次调用的状态"""
+    # 系统提示词作为类常量只创建一次，__init__ 中再与固定说明拼成静态前缀
+    SYSTEM_PROMPT = """你是一位知识助手，请根据用户的问题和下列片段生成准确的回答。请不要在回答中使用任何表情符号。 """
+    STREAM_SYSTEM_PROMPT = """你是一位知识助手，请根据用户的问题和可能的相关背景知识。请不要在回答中使用任何表情符号 ."""
+
     def __init__(self, app_id=None):
         """
         初始化LLM模型实例
@@ -20,6 +221,23 @@ class LLM_model:
         if not self.app_id:
             raise ValueError("请提供 app_id 或在.env文件中设置 LLM_appid")
 
+        # 提示词中不随请求变化的部分只拼接一次，并放在最前面：
+        # 服务端的前缀缓存只能复用第一个不同字节之前的内容，动态的片段和问题统一放到末尾
+        self._static_prefix = (
+            f"{self.get_system_prompt()}\n\n"
+            f"请基于<context>中的相关片段回答<question>中的用户问题，不要编造信息，不要使用表情符号。\n\n"
+            f"<context>\n"
+        )
+        self._stream_static_prefix = (
+            f"{self.get_stream_system_prompt()}\n\n"
+            f"<context>中是背景知识，<question>中是用户问题。"
+            f"若用户问题与背景知识无关，则用通用知识解决问题。请不要使用表情符号。\n\n"
+            f"<context>\n"
+        )
+        # 静态前缀的 JSON 转义结果同样只计算一次，每次请求只转义片段和问题
+        self._prefix_json = prompt_prefix_json(self._static_prefix)
+        self._stream_prefix_json = prompt_prefix_json(self._stream_static_prefix)
+
     def start_LLM(self):
         """
         启动LLM服务
@@ -31,15 +249,30 @@ class LLM_model:
 
     def get_system_prompt(self):
         """
-        获取系统提示词，子类可以重写此方法
+        获取系统提示词，子类通过 SYSTEM_PROMPT 覆盖
         """
-        return """你是一位知识助手，请根据用户的问题和下列片段生成准确的回答。请不要在回答中使用任何表情符号。 """
+        return self.SYSTEM_PROMPT
 
     def get_stream_system_prompt(self):
         """
-        获取系统提示词，子类可以重写此方法
+        获取流式调用的系统提示词，子类通过 STREAM_SYSTEM_PROMPT 覆盖
         """
-        return """你是一位知识助手，请根据用户的问题和可能的相关背景知识。请不要在回答中使用任何表情符号 ."""
+        return self.STREAM_SYSTEM_PROMPT
+
+    @staticmethod
+    def _dynamic_prompt(query, chunks) -> str:
+        """提示词中静态前缀之后的动态部分（相关片段、用户问题）"""
+        return "\n\n".join(chunks) + "\n</context>\n<question>" + query + "</question>"
+
+    def _build_prompt(self, static_prefix, query, chunks) -> str:
+        """静态前缀 + 动态部分，得到完整提示词"""
+        return static_prefix + self._dynamic_prompt(query, chunks)
+
+    def _body(self, query, chunks, stream=False) -> bytes:
+        """生成请求体；流式请求使用流式提示词并开启增量输出"""
+        prefix_json = self._stream_prefix_json if stream else self._prefix_json
+        return _request_body(prefix_json, self._dynamic_prompt(query, chunks), self.session_id,
+                             incremental_output=stream)
 
     def call_llm(self, query, list) -> str:
         """
@@ -52,83 +285,96 @@ class LLM_model:
         Returns:
             str: 生成的回答文本
         """
-        separator = "\n\n"
-        system_prompt = self.get_system_prompt()
-        prompt = f"""{system_prompt}
-
-用户问题: {query}
-
-相关片段:
-{separator.join(list)}
-
-请基于上述内容作答，不要编造信息，不要使用表情符号。"""
-
-        resp = Application.call(
+        resp = _dashscope_call(
             api_key=self.api_key,
             app_id=self.app_id,
-            prompt=prompt,
-            session_id=self.session_id
+            body=self._body(query, list)
         )
 
         if resp.status_code != HTTPStatus.OK:
             raise RuntimeError(f"API调用失败: {resp}")
         return resp.output.text
 
-    def call_llm_stream(self, query, list):
+    async def acall_llm(self, query, list, client: httpx.AsyncClient) -> str:
         """
-        流式生成回答，只返回增量字符
+        call_llm 的异步版本，通过传入的 httpx.AsyncClient 直接请求 REST 接口，
+        多个请求可以用 asyncio.gather 并发发出
 
         Args:
             query (str): 用户问题
             list (list): 相关文档片段列表
+            client (httpx.AsyncClient): 复用的异步客户端
 
-        Yields:
-            str: 生成的文本增量
+        Returns:
+            str: 生成的回答文本
         """
-        separator = "\n\n"
-        system_prompt = self.get_stream_system_prompt()
-        prompt = f"""{system_prompt}
+        url, headers = _app_request(self.api_key, self.app_id)
+        resp = await client.post(url, headers=headers, content=self._body(query, list))
 
-用户问题: {query}
+        if resp.status_code != HTTPStatus.OK:
+            raise RuntimeError(f"API调用失败: {resp.status_code} {resp.text}")
+        return resp.json()["output"]["text"]
 
-背景知识:
-{separator.join(list)}
+    def call_llm_stream(self, query, list):
+        """
+        流式生成回答，只返回增量字符
 
-若用户问题与背景知识无关，则用通用知识解决问题。请不要使用表情符号。
-"""
+        Args:
+            query (str): 用户问题
+            list (list): 相关文档片段列表
 
-        prev = ""
-        responses = Application.call(
+        Yields:
+            str: 生成的文本增量
+
+        Returns:
+            bool: 流是否完整结束（接口返回错误提前结束时为 False）；用 `ok = yield from ...` 取得。
+                状态随本次调用返回而不是记在实例上，同一实例可以被多个请求并发使用
+        """
+        responses = _dashscope_call(
             api_key=self.api_key,
             app_id=self.app_id,
-            prompt=prompt,
-            session_id=self.session_id,
+            body=self._body(query, list, stream=True),
             stream=True
         )
 
         for response in responses:
             if response.status_code == HTTPStatus.OK:
-                current = response.output.text
-                delta = current[len(prev):]
-                prev = current
+                # 增量输出模式下 output.text 就是本次新增的文本，不需要再和累计文本做切片
+                delta = response.output.text
                 if delta:
                     yield delta
             else:
-                print(f'Request id: {response.request_id}')
-                print(f'Status code: {response.status_code}')
-                print(f'Error code: {response.code}')
-                print(f'Error message: {response.message}')
-                break
+                _print_stream_error(response)
+                return False
+        return True
+
+    async def acall_llm_stream(self, query, list, client: httpx.AsyncClient):
+        """
+        call_llm_stream 的异步版本，生成过程中不占用线程
+
+        Args:
+            query (str): 用户问题
+            list (list): 相关文档片段列表
+            client (httpx.AsyncClient): 复用的异步客户端
+
+        Yields:
+            str: 生成的文本增量
+
+        Raises:
+            RuntimeError: 接口返回错误（已输出的增量不受影响）
+        """
+        body = self._body(query, list, stream=True)
+        async for response in _aiter_sse(client, self.api_key, self.app_id, body):
+            if response.status_code != HTTPStatus.OK:
+                _print_stream_error(response)
+                raise RuntimeError(f"API调用失败: {response.status_code} {response.message}")
+            if response.output.text:
+                yield response.output.text
 
 
 # 四个专门的智能体类
 class LLM_psychology(LLM_model):
-    def __init__(self):
-        app_id = os.getenv("APP_ID_PSYCHOLOGY")
-        super().__init__(app_id=app_id)
-
-    def get_system_prompt(self):
-        return """你是一个专业的心理健康助手。请基于心理学知识为用户提供帮助和建议。
+    SYSTEM_PROMPT = """你是一个专业的心理健康助手。请基于心理学知识为用户提供帮助和建议。
 请遵循以下原则：
 1. 保持温暖、理解和同理心的语调
 2. 提供科学、专业的心理学建议
@@ -137,8 +383,7 @@ class LLM_psychology(LLM_model):
 5. 关注用户的情感需求和心理健康
 请根据检索到的心理学文档内容来回答用户的问题。请不要在回答中使用任何表情符号。"""
 
-    def get_stream_system_prompt(self):
-        return """你是一个专业的心理健康助手。请基于心理学知识和相关背景知识为用户提供帮助和建议。
+    STREAM_SYSTEM_PROMPT = """你是一个专业的心理健康助手。请基于心理学知识和相关背景知识为用户提供帮助和建议。
 请遵循以下原则：
 1. 保持温暖、理解和同理心的语调
 2. 提供科学、专业的心理学建议
@@ -147,14 +392,13 @@ class LLM_psychology(LLM_model):
 5. 关注用户的情感需求和心理健康
 若用户问题与心理学背景知识无关，请用心理健康的角度和通用知识来解决问题。请不要使用表情符号。"""
 
-
-class LLM_fitness(LLM_model):
     def __init__(self):
-        app_id = os.getenv("APP_ID_FITNESS")
+        app_id = os.getenv("APP_ID_PSYCHOLOGY")
         super().__init__(app_id=app_id)
 
-    def get_system_prompt(self):
-        return """你是一个专业的健身和营养助手。请基于运动科学和营养学知识为用户提供专业建议。
+
+class LLM_fitness(LLM_model):
+    SYSTEM_PROMPT = """你是一个专业的健身和营养助手。请基于运动科学和营养学知识为用户提供专业建议。
 请遵循以下原则：
 1. 提供科学、安全的健身建议
 2. 给出合理的营养和饮食建议
@@ -164,8 +408,7 @@ class LLM_fitness(LLM_model):
 6. 如涉及严重健康问题，建议咨询医生或营养师
 请根据检索到的健身和营养文档内容来回答用户的问题。请不要在回答中使用任何表情符号。"""
 
-    def get_stream_system_prompt(self):
-        return """你是一个专业的健身和营养助手。请基于运动科学、营养学知识和相关背景知识为用户提供专业建议。
+    STREAM_SYSTEM_PROMPT = """你是一个专业的健身和营养助手。请基于运动科学、营养学知识和相关背景知识为用户提供专业建议。
 请遵循以下原则：
 1. 提供科学、安全的健身建议
 2. 给出合理的营养和饮食建议
@@ -175,14 +418,13 @@ class LLM_fitness(LLM_model):
 6. 如涉及严重健康问题，建议咨询医生或营养师
 若用户问题与健身营养背景知识无关，请用健康生活的角度和通用知识来解决问题。请不要使用表情符号。"""
 
-
-class LLM_compus(LLM_model):
     def __init__(self):
-        app_id = os.getenv("APP_ID_CAMPUS")
+        app_id = os.getenv("APP_ID_FITNESS")
         super().__init__(app_id=app_id)
 
-    def get_system_prompt(self):
-        return """你是一个校园知识问答助手。请基于校园相关信息为学生提供准确的帮助。
+
+class LLM_compus(LLM_model):
+    SYSTEM_PROMPT = """你是一个校园知识问答助手。请基于校园相关信息为学生提供准确的帮助。
 请遵循以下原则：
 1. 提供准确、及时的校园信息
 2. 详细解答学术、生活、服务相关问题
@@ -191,8 +433,7 @@ class LLM_compus(LLM_model):
 5. 提供相关的联系方式或办事地点（如果有的话）
 请根据检索到的校园知识文档内容来回答用户的问题。请不要在回答中使用任何表情符号。"""
 
-    def get_stream_system_prompt(self):
-        return """你是一个校园知识问答助手。请基于校园相关信息和背景知识为学生提供准确的帮助。
+    STREAM_SYSTEM_PROMPT = """你是一个校园知识问答助手。请基于校园相关信息和背景知识为学生提供准确的帮助。
 请遵循以下原则：
 1. 提供准确、及时的校园信息
 2. 详细解答学术、生活、服务相关问题
@@ -201,14 +442,13 @@ class LLM_compus(LLM_model):
 5. 提供相关的联系方式或办事地点（如果有的话）
 若用户问题与校园背景知识无关，请用学生服务的角度和通用知识来解决问题。请不要使用表情符号。"""
 
-
-class LLM_paper(LLM_model):
     def __init__(self):
-        app_id = os.getenv("APP_ID_PAPER")
+        app_id = os.getenv("APP_ID_CAMPUS")
         super().__init__(app_id=app_id)
 
-    def get_system_prompt(self):
-        return """你是一个专业的学术论文写作助手。请基于学术资料和研究方法为用户提供论文写作指导。
+
+class LLM_paper(LLM_model):
+    SYSTEM_PROMPT = """你是一个专业的学术论文写作助手。请基于学术资料和研究方法为用户提供论文写作指导。
 请遵循以下原则：
 1. 提供专业、严谨的学术建议
 2. 遵循学术规范和引用标准
@@ -218,8 +458,7 @@ class LLM_paper(LLM_model):
 6. 鼓励原创性和批判性思维
 请根据检索到的学术文档内容来回答用户的问题。请不要在回答中使用任何表情符号。"""
 
-    def get_stream_system_prompt(self):
-        return """你是一个专业的学术论文写作助手。请基于学术资料、研究方法和背景知识为用户提供论文写作指导。
+    STREAM_SYSTEM_PROMPT = """你是一个专业的学术论文写作助手。请基于学术资料、研究方法和背景知识为用户提供论文写作指导。
 请遵循以下原则：
 1. 提供专业、严谨的学术建议
 2. 遵循学术规范和引用标准
@@ -227,4 +466,8 @@ class LLM_paper(LLM_model):
 4. 提供研究方法和数据分析建议
 5. 强调学术诚信的重要性
 6. 鼓励原创性和批判性思维
-若用户问题与学术背景知识无关，请用学术研究的角度和通用知识来解决问题。请不要使用表情符号。"""
\ No newline at end of file
+若用户问题与学术背景知识无关，请用学术研究的角度和通用知识来解决问题。请不要使用表情符号。"""
+
+    def __init__(self):
+        app_id = os.getenv("APP_ID_PAPER")
+        super().__init__(app_id=app_id)
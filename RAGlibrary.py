@@ -3,17 +3,86 @@ from LLMmodel import LLM_psychology
 from LLMmodel import LLM_fitness
 from LLMmodel import LLM_compus
 from LLMmodel import LLM_paper
+from LLMmodel import new_async_client, get_async_client, warm_connection
 from faiss_store import FAISSVectorStore  # 引入FAISS向量存储
-from retrieve_model import retrieve_relevant_chunks
-from sentence_transformers import SentenceTransformer
+from retrieve_model import retrieve_relevant_chunks, batch_retrieve_relevant_chunks
+from embedding_loader import load_embedding_model, load_cross_encoder, encode_float32, CROSS_ENCODER_PATH
 from sentence_transformers import CrossEncoder
+from collections import OrderedDict
+import asyncio
+import threading
+import time
+import weakref
+import math
+import numpy as np
+import faiss
 import torch
 
 collection_name = "document_embeddings"
-local_model_path = "./cross-encoder-model"
+local_model_path = CROSS_ENCODER_PATH
+embedding_model_path = "./Qwen3-Embedding-0.6B"
+
+
+class _ModelPool:
+    """进程内模型池：相同配置的模型（嵌入模型、交叉编码器、LLM 客户端）在所有 RAG 实例间只加载一份
+
+    以构造参数组成的元组为键，按引用计数管理生命周期，最后一个使用者 release 后才释放
+    """
+    _models: dict = {}
+    _refcounts: dict = {}
+    _key_locks: dict = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_or_create(cls, key, factory):
+        """取出 key 对应的实例并增加引用计数，不存在时调用 factory 创建"""
+        with cls._lock:
+            if key in cls._models:
+                cls._refcounts[key] += 1
+                return cls._models[key]
+            key_lock = cls._key_locks.setdefault(key, threading.Lock())
+
+        # 加载在全局锁之外进行，不同模型可以并行加载，同一模型只加载一次
+        with key_lock:
+            with cls._lock:
+                if key in cls._models:
+                    cls._refcounts[key] += 1
+                    return cls._models[key]
+            instance = factory()
+            with cls._lock:
+                cls._models[key] = instance
+                cls._refcounts[key] = 1
+            return instance
+
+    @classmethod
+    def release(cls, key):
+        """减少引用计数，归零时从池中移除"""
+        with cls._lock:
+            if key not in cls._refcounts:
+                return
+            cls._refcounts[key] -= 1
+            if cls._refcounts[key] > 0:
+                return
+            del cls._refcounts[key]
+            cls._models.pop(key, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
 
 class RAG():
+    # 异步接口中编码、检索、重排共用一块GPU，同一时刻只允许一个请求占用；大模型请求不受限制。
+    # asyncio.Semaphore 绑定首个使用它的事件循环，因此按事件循环各建一个（脚本里多次 asyncio.run 也能用）
+    _gpu_sems = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def _gpu_sem(cls) -> asyncio.Semaphore:
+        """当前事件循环的GPU信号量"""
+        loop = asyncio.get_running_loop()
+        sem = cls._gpu_sems.get(loop)
+        if sem is None:
+            sem = cls._gpu_sems[loop] = asyncio.Semaphore(1)
+        return sem
+
     def __init__(self):
         self.tim = 0
         # 子类可以重写这些属性（在调用super()._init_()之前设置）
@@ -26,13 +95,23 @@ class RAG():
         print(f"🔧 初始化向量存储: index_path={self.index_path}, collection={self.collection}")
         self.vector_store = FAISSVectorStore(
             index_path=self.index_path,  # ✅ 使用子类设置的路径
-            collection_name=self.collection  # ✅ 使用子类设置的集合名
+            collection_name=self.collection,  # ✅ 使用子类设置的集合名
+            mmap=True,  # 检索服务只读，多个进程共享索引文件的页缓存
+            use_gpu=True  # 安装了 faiss-gpu 且有GPU时在显存中检索，否则自动使用CPU索引
         )
 
-        # 子类可以重写LLM属性
+        # 本实例从模型池取得的键，close() 时释放
+        self._pool_keys = []
+
+        # 子类可以重写LLM属性（通过 llm_class 指定智能体类，同类智能体共享一个实例）
+        # 共享实例会被多个 RAG 对象和线程池中的并发请求同时调用，只能持有构造时确定的只读配置，
+        # 单次调用的状态（如流式调用是否完整结束）必须通过返回值传给调用方
         if not hasattr(self, 'llm'):
-            self.llm = LLM_model()
+            llm_class = getattr(self, 'llm_class', LLM_model)
+            self.llm = self._pooled(("llm", llm_class), llm_class)
         self.llm.start_LLM()
+        # 后台预先建立到大模型服务的连接，首个请求不再等待握手
+        warm_connection()
 
         # 优化：检查CUDA可用性
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -40,58 +119,418 @@ class RAG():
         # 优化：延迟加载模型以减少初始化时间
         self._cross_encoder = None
         self._embedding_model = None
+
+        # 语义回答缓存：以往查询的归一化向量放在内积索引中，相似度超过阈值时直接返回之前的完整回答
+        self.qcache_threshold = 0.92
+        self.qcache_max_size = 512
+        self._qcache_index = None  # 首次写入时按嵌入维度创建
+        self._qcache_answers = OrderedDict()  # 索引id -> (回答, 规范化后的查询)，按最近访问顺序淘汰（LRU）
+        self._qcache_exact = {}  # 规范化后的查询 -> 索引id：完全相同的查询连编码都不需要
+        self._qcache_next_id = 0
+        self._qcache_lock = threading.Lock()
+        # 查询向量缓存：规范化后的查询 -> 向量，重复的常见问题不必再过一遍嵌入模型（LRU）
+        self.qemb_cache_size = 2048
+        self._qemb_cache = OrderedDict()
+        self._qemb_lock = threading.Lock()
+
+        # 异步接口的微批处理：在 batch_window 秒内到达的并发查询合并为一次编码、一次检索、一次重排
+        self.batch_window = 0.005
+        self.max_batch_size = 32
+        self._batch_queue = None
+        self._batch_task = None
+        self._batch_loop = None
     
+    def _pooled(self, key, factory):
+        """从模型池获取共享实例，并记录以便 close() 时释放"""
+        instance = _ModelPool.get_or_create(key, factory)
+        self._pool_keys.append(key)
+        return instance
+
+    def load_models(self):
+        """立即加载嵌入模型和交叉编码器（默认在首次查询时才加载），返回 (嵌入模型, 交叉编码器)
+
+        服务在启动时调用，首个请求不必等待模型加载；模型来自模型池，之后所有请求复用
+        """
+        return self.model, self.cross_encoder
+
+    def close(self):
+        """释放本实例占用的共享模型"""
+        for key in self._pool_keys:
+            _ModelPool.release(key)
+        self._pool_keys = []
+        self._cross_encoder = None
+        self._embedding_model = None
+
     @property
     def cross_encoder(self):
-        """延迟加载交叉编码器"""
+        """延迟加载交叉编码器（相同路径和设备的实例共享）"""
         if self._cross_encoder is None:
-            self._cross_encoder = CrossEncoder(local_model_path)
+            self._cross_encoder = self._pooled(
+                ("cross_encoder", local_model_path, self.device),
+                lambda: load_cross_encoder(local_model_path, device=self.device)
+            )
         return self._cross_encoder
     
     @property
     def model(self):
-        """延迟加载嵌入模型"""
+        """延迟加载嵌入模型（相同路径和设备的实例共享）"""
         if self._embedding_model is None:
-            self._embedding_model = SentenceTransformer(
-                "./Qwen3-Embedding-0.6B",
-                tokenizer_kwargs={"padding_side": "left"},
-                trust_remote_code=True,
-                device=self.device
+            self._embedding_model = self._pooled(
+                ("embedding", embedding_model_path, self.device),
+                lambda: load_embedding_model(embedding_model_path, device=self.device)
             )
         return self._embedding_model
-    
 
+    @staticmethod
+    def _normalize_query(query):
+        """缓存键：去掉首尾和重复空白，英文统一小写"""
+        return " ".join(query.split()).lower()
 
-    def call_RAG_stream(self, query):
-        """流式RAG调用
-        
-        Args:
-            query: 用户查询
+    def _encode_queries(self, queries, batch_size=32):
+        """批量编码查询（与检索使用相同的 query 提示），返回 shape 为 (N, dim) 的 float32 归一化向量
+
+        先查查询向量缓存，只编码未缓存的查询
         """
+        keys = [self._normalize_query(q) for q in queries]
+        rows = [None] * len(queries)
+        with self._qemb_lock:
+            for i, key in enumerate(keys):
+                row = self._qemb_cache.get(key)
+                if row is not None:
+                    self._qemb_cache.move_to_end(key)
+                    rows[i] = row
+        misses = [i for i, row in enumerate(rows) if row is None]
+        if not misses:
+            return np.vstack(rows)
+
+        encoded = encode_float32(
+            self.model,
+            [queries[i] for i in misses],
+            prompt_name="query",
+            batch_size=batch_size,
+            normalize_embeddings=True
+        )
+        if len(misses) == len(queries):
+            result = encoded
+        else:
+            result = np.empty((len(queries), encoded.shape[1]), dtype=np.float32)
+            for i, row in enumerate(rows):
+                if row is not None:
+                    result[i] = row
+            result[misses] = encoded
+
+        with self._qemb_lock:
+            for j, i in enumerate(misses):
+                self._qemb_cache[keys[i]] = encoded[j].copy()  # 拷贝一行，不引用整批矩阵
+                self._qemb_cache.move_to_end(keys[i])
+            while len(self._qemb_cache) > self.qemb_cache_size:
+                self._qemb_cache.popitem(last=False)
+        return result
+
+    def _encode_query(self, query):
+        """编码单个查询，返回 shape 为 (1, dim) 的向量"""
+        return self._encode_queries([query])
+
+    def _qcache_hit(self, qid):
+        """取出缓存的回答并标记为最近使用（需持有锁）"""
+        entry = self._qcache_answers.get(qid)
+        if entry is None:
+            return None
+        self._qcache_answers.move_to_end(qid)
+        return entry[0]
+
+    def _qcache_lookup_exact(self, query):
+        """按规范化后的查询文本精确查找，命中时无需编码"""
+        with self._qcache_lock:
+            qid = self._qcache_exact.get(self._normalize_query(query))
+            return None if qid is None else self._qcache_hit(qid)
+
+    def _qcache_lookup(self, q_emb):
+        """在语义缓存中查找相似查询，命中返回缓存的回答，否则返回 None"""
+        with self._qcache_lock:
+            if self._qcache_index is None or self._qcache_index.ntotal == 0:
+                return None
+            scores, ids = self._qcache_index.search(q_emb, 1)
+            if ids[0, 0] >= 0 and scores[0, 0] > self.qcache_threshold:
+                return self._qcache_hit(int(ids[0, 0]))
+        return None
+
+    def _qcache_store(self, q_emb, answer, query=None):
+        """写入语义缓存，超出容量时淘汰最久未使用的条目"""
+        if not answer:
+            return
+        with self._qcache_lock:
+            if self._qcache_index is None:
+                self._qcache_index = faiss.IndexIDMap2(faiss.IndexFlatIP(q_emb.shape[1]))
+            qid = self._qcache_next_id
+            self._qcache_next_id += 1
+            self._qcache_index.add_with_ids(q_emb, np.array([qid], dtype=np.int64))
+            key = None if query is None else self._normalize_query(query)
+            self._qcache_answers[qid] = (answer, key)
+            if key is not None:
+                self._qcache_exact[key] = qid
+
+            while len(self._qcache_answers) > self.qcache_max_size:
+                old_id, (_, old_query) = self._qcache_answers.popitem(last=False)
+                self._qcache_index.remove_ids(np.array([old_id], dtype=np.int64))
+                if self._qcache_exact.get(old_query) == old_id:
+                    del self._qcache_exact[old_query]
+
+    def clear_qcache(self):
+        """清空语义回答缓存和查询向量缓存"""
+        with self._qcache_lock:
+            self._qcache_index = None
+            self._qcache_answers.clear()
+            self._qcache_exact.clear()
+        with self._qemb_lock:
+            self._qemb_cache.clear()
+
+    @staticmethod
+    def _replay_plan(text, short_thr=100, long_thr=2000, min_delay=0.002, max_delay=0.02):
+        """回放缓存回答时的分段长度和间隔
+
+        短回答用小分段、较长间隔，长回答用大分段、较短间隔；间隔在 [min_delay, max_delay] 之间按长度取对数插值
+        """
+        length = len(text)
+        size = 8 if length <= short_thr else 32
+        ratio = math.log(max(length, short_thr) / short_thr) / math.log(long_thr / short_thr)
+        ratio = min(ratio, 1.0)
+        return size, max_delay - ratio * (max_delay - min_delay)
+
+    def _replay_stream(self, text):
+        """把缓存的完整回答切成小段逐段产出，保持与真实流式输出相同的逐步呈现效果"""
+        if not text:
+            return
+        size, delay = self._replay_plan(text)
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
+            time.sleep(delay)
+
+    async def _areplay_stream(self, text):
+        """_replay_stream 的异步版本"""
+        if not text:
+            return
+        size, delay = self._replay_plan(text)
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
+            await asyncio.sleep(delay)
+
+    def _prepare(self, query):
+        """编码查询并查缓存，未命中时检索相关片段
+
+        Returns:
+            (查询向量, 缓存的回答或 None, 相关片段列表)；精确命中时查询向量为 None
+        """
+        cached = self._qcache_lookup_exact(query)
+        if cached is not None:
+            return None, cached, None
+        q_emb = self._encode_query(query)
+        cached = self._qcache_lookup(q_emb)
+        if cached is not None:
+            return q_emb, cached, None
         chunks = retrieve_relevant_chunks(
             user_query=query,
             vector_store=self.vector_store,
             embedding_model=self.model,
-            cross_encoder1=self.cross_encoder
+            cross_encoder1=self.cross_encoder,
+            query_embedding=q_emb[0]
         )
-        
-        for delta in self.llm.call_llm_stream(query, chunks):
+        return q_emb, None, chunks
+
+    def _prepare_batch(self, queries):
+        """批量版的 _prepare：所有查询一次编码、一次 FAISS 检索、一次交叉编码器打分
+
+        Returns:
+            list: 与输入顺序一致的 (查询向量, 缓存的回答或 None, 相关片段列表)
+        """
+        results = [(None, self._qcache_lookup_exact(query), None) for query in queries]
+        pending = [i for i, (_, cached, _) in enumerate(results) if cached is None]
+        if not pending:
+            return results
+
+        q_embs = self._encode_queries([queries[i] for i in pending])
+        misses = []
+        for row, i in enumerate(pending):
+            q_emb = q_embs[row:row + 1]
+            cached = self._qcache_lookup(q_emb)
+            results[i] = (q_emb, cached, None)
+            if cached is None:
+                misses.append((row, i))
+        if not misses:
+            return results
+
+        chunk_lists = batch_retrieve_relevant_chunks(
+            [queries[i] for _, i in misses],
+            vector_store=self.vector_store,
+            embedding_model=self.model,
+            cross_encoder1=self.cross_encoder,
+            query_embeddings=q_embs[[row for row, _ in misses]]
+        )
+        for (row, i), chunks in zip(misses, chunk_lists):
+            results[i] = (q_embs[row:row + 1], None, chunks)
+        return results
+
+    async def _aprepare(self, query):
+        """异步版的 _prepare：查询进入微批队列，与同一时间窗内的其他查询一起在线程池中处理"""
+        loop = asyncio.get_running_loop()
+        if self._batch_loop is not loop or self._batch_task is None or self._batch_task.done():
+            self._batch_queue = asyncio.Queue()
+            self._batch_loop = loop
+            self._batch_task = loop.create_task(self._run_batches(self._batch_queue))
+        future = loop.create_future()
+        self._batch_queue.put_nowait((query, future))
+        return await future
+
+    async def _run_batches(self, queue):
+        """后台任务：收集 batch_window 内到达（最多 max_batch_size 个）的查询，合并处理后分别返回结果"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                async with RAG._gpu_sem():
+                    results = await asyncio.to_thread(self._prepare_batch, [query for query, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():  # 请求方可能已断开
+                    future.set_result(result)
+
+    @staticmethod
+    def _collect_stream(stream, parts):
+        """转发流式增量并记录到 parts，返回流本身的返回值（call_llm_stream 返回是否完整结束）"""
+        while True:
+            try:
+                delta = next(stream)
+            except StopIteration as stop:
+                return stop.value
+            parts.append(delta)
             yield delta
 
+    def call_RAG_stream(self, query):
+        """流式RAG调用
+        
+        Args:
+            query: 用户查询
+        """
+        warm_connection()  # 连接可能已过期时在后台重连，与下面的编码、检索并行
+        q_emb, cached, chunks = self._prepare(query)
+        if cached is not None:
+            yield from self._replay_stream(cached)
+            return
+
+        parts = []
+        completed = yield from self._collect_stream(self.llm.call_llm_stream(query, chunks), parts)
+
+        # 只缓存完整生成的回答（流式接口出错时会提前结束）
+        if completed:
+            self._qcache_store(q_emb, "".join(parts), query)
+
     def call_RAG(self, query):
         """标准RAG调用
         
         Args:
             query: 用户查询
         """
-        chunks = retrieve_relevant_chunks(
-            user_query=query,
-            vector_store=self.vector_store,
-            embedding_model=self.model,
-            cross_encoder1=self.cross_encoder
-        )
-        
-        return self.llm.call_llm(query, chunks)
+        warm_connection()  # 连接可能已过期时在后台重连，与下面的编码、检索并行
+        q_emb, cached, chunks = self._prepare(query)
+        if cached is not None:
+            return cached
+
+        answer = self.llm.call_llm(query, chunks)
+        self._qcache_store(q_emb, answer, query)
+        return answer
+
+    async def acall_RAG_stream(self, query):
+        """异步流式RAG调用，供并发服务多个用户使用
+
+        编码、检索和重排放到线程池执行（PyTorch/FAISS 在 C 代码中释放 GIL），并由信号量串行化对GPU的使用；
+        同一时间窗内到达的并发查询合并成一批处理（见 _aprepare）；
+        大模型的流式响应由单独的任务读取并写入队列，慢速的下游消费者不会阻塞网络读取
+
+        Args:
+            query: 用户查询
+        """
+        q_emb, cached, chunks = await self._aprepare(query)
+
+        if cached is not None:
+            async for delta in self._areplay_stream(cached):
+                yield delta
+            return
+
+        queue = asyncio.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async for delta in self.llm.acall_llm_stream(query, chunks, get_async_client()):
+                    queue.put_nowait(delta)
+                queue.put_nowait(done)
+            except Exception as e:
+                queue.put_nowait(e)
+
+        producer = asyncio.create_task(produce())
+        parts = []
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    print(f"流式调用失败: {item}")
+                    return  # 与同步接口一致：出错时结束流，不缓存不完整的回答
+                parts.append(item)
+                yield item
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+        self._qcache_store(q_emb, "".join(parts), query)
+
+    async def acall_RAG(self, queries):
+        """批量异步RAG调用
+
+        所有查询一次编码、一次检索，未命中语义缓存的查询并发请求大模型，
+        总耗时约为最慢的一次调用而不是所有调用之和
+
+        Args:
+            queries: 用户查询列表
+
+        Returns:
+            list: 与输入顺序一致的回答列表
+        """
+        if not queries:
+            return []
+        async with RAG._gpu_sem():
+            prepared = await asyncio.to_thread(self._prepare_batch, queries)
+
+        answers = [cached for _, cached, _ in prepared]
+        misses = [i for i, answer in enumerate(answers) if answer is None]
+        if not misses:
+            return answers
+
+        async with new_async_client() as client:
+            generated = await asyncio.gather(*[
+                self.llm.acall_llm(queries[i], prepared[i][2], client)
+                for i in misses
+            ])
+
+        for i, answer in zip(misses, generated):
+            answers[i] = answer
+            self._qcache_store(prepared[i][0], answer, queries[i])
+        return answers
 
 #====================子类助手====================
 #心理助手
@@ -99,7 +538,7 @@ class RAG_psychology(RAG):
     def __init__(self):
         self.index_path = "./faiss_index/psychology"  # ✅ 正确路径
         self.collection = "psychology_docs"           # ✅ 正确集合名
-        self.llm = LLM_psychology()
+        self.llm_class = LLM_psychology
         super().__init__()
 
 #健身饮食助手
@@ -107,7 +546,7 @@ class RAG_fitness(RAG):
     def __init__(self):
         self.index_path = "./faiss_index/fitness"     # ✅ 正确路径
         self.collection = "fitness_docs"              # ✅ 正确集合名
-        self.llm = LLM_fitness()
+        self.llm_class = LLM_fitness
         super().__init__()
 
 #校园知识问答
@@ -115,7 +554,7 @@ class RAG_compus(RAG):
     def __init__(self):
         self.index_path = "./faiss_index/campus"      # ✅ 正确路径
         self.collection = "campus_docs"               # ✅ 正确集合名
-        self.llm = LLM_compus()
+        self.llm_class = LLM_compus
         super().__init__()
 
 #论文助手
@@ -123,5 +562,5 @@ class RAG_paper(RAG):
     def __init__(self):
         self.index_path = "./faiss_index/paper"       # ✅ 正确路径
         self.collection = "paper_docs"                # ✅ 正确集合名
-        self.llm = LLM_paper()
-        super().__init__()
\ No newline at end of file
+        self.llm_class = LLM_paper
+        super().__init__()
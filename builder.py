@@ -1,13 +1,33 @@
+from embedding_loader import load_embedding_model, encode_length_sorted, EMBED_DIM  # 需确保transformers>=4.51.0和sentence-transformers>=3.2.0
 import tiktoken
 import numpy as np
 import os  # 新增：用于文件路径处理
+import json
+import hashlib
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import torch
 import PyPDF2  # 处理PDF
+try:
+    import pypdfium2 as pdfium  # 可选：基于 PDFium 的原生文本提取，比 PyPDF2 快得多
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    PDFIUM_AVAILABLE = False
 from docx import Document  # 处理Word
 from faiss_store import FAISSVectorStore  # 引入FAISS向量存储
-from sentence_transformers import SentenceTransformer  # 需确保transformers>=4.51.0和sentence-transformers>=2.7.0
 from textsplitters import RecursiveCharacterTextSplitter
 
 
+# read_file 支持的文件扩展名
+SUPPORTED_EXTENSIONS = {'.txt', '.md', '.markdown', '.pdf', '.docx'}
+
+# 扫描件检测：前 SCANNED_PDF_PROBE_PAGES 页的文字少于 SCANNED_PDF_MIN_CHARS 个字符时不再解析后续页面
+SCANNED_PDF_PROBE_PAGES = 2
+SCANNED_PDF_MIN_CHARS = 50
+
+
 # 定义所有通用的辅助函数，这些函数不依赖于具体的类
 # 注意：函数名统一为不带下划线的，方便直接调用
 def read_file(filename: str) -> str:
@@ -43,13 +63,22 @@ def read_file(filename: str) -> str:
             raise Exception(f"读取md文件出错: {str(e)}")
 
     elif filename.endswith('.pdf'):
+        if PDFIUM_AVAILABLE:
+            try:
+                return read_pdf_pdfium(filename)
+            except Exception as e:
+                print(f"pypdfium2 读取 {filename} 失败: {str(e)}，改用 PyPDF2")
         try:
-            text = ""
             with open(filename, 'rb') as file:
                 reader = PyPDF2.PdfReader(file)
-                for page in reader.pages:
-                    text += page.extract_text() or ""
-            return text
+                # 逐页收集后一次拼接，避免长文档反复重新分配字符串
+                texts = []
+                for i, page in enumerate(reader.pages):
+                    texts.append(page.extract_text() or "")
+                    if i + 1 == SCANNED_PDF_PROBE_PAGES and _looks_scanned(texts, len(reader.pages)):
+                        print(f"{filename} 前 {SCANNED_PDF_PROBE_PAGES} 页几乎没有文本，疑似扫描件，跳过")
+                        return ""
+                return "".join(texts)
         except Exception as e:
             raise Exception(f"读取pdf文件出错: {str(e)}")
 
@@ -64,9 +93,36 @@ def read_file(filename: str) -> str:
         raise ValueError(f"不支持的文件格式: {filename}")
 
 
+def _looks_scanned(texts: list[str], n_pages: int) -> bool:
+    """前几页几乎提取不到文字时认为是纯图片的扫描件：继续解析只是在解压图片，得不到文本"""
+    return n_pages > SCANNED_PDF_PROBE_PAGES and sum(len(t.strip()) for t in texts) < SCANNED_PDF_MIN_CHARS
+
+
+def read_pdf_pdfium(filename: str) -> str:
+    """使用 pypdfium2 提取PDF文本"""
+    pdf = pdfium.PdfDocument(filename)
+    try:
+        texts = []
+        for i, page in enumerate(pdf):
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_bounded())
+            textpage.close()
+            page.close()
+            if i + 1 == SCANNED_PDF_PROBE_PAGES and _looks_scanned(texts, len(pdf)):
+                print(f"{filename} 前 {SCANNED_PDF_PROBE_PAGES} 页几乎没有文本，疑似扫描件，跳过")
+                return ""
+        return "\n".join(texts)
+    finally:
+        pdf.close()
+
+
+# 编码器只加载一次；分割器会对每个候选片段调用 token_length_function
+_ENC = tiktoken.get_encoding('cl100k_base')
+
+
 def token_length_function(text: str) -> int:
-    encoding = tiktoken.get_encoding('cl100k_base')
-    return len(encoding.encode(text))
+    # 文档文本中不含特殊 token，encode_ordinary 省去特殊 token 的检查
+    return len(_ENC.encode_ordinary(text))
 
 
 def split_document(filename: str) -> list[str]:
@@ -74,10 +130,29 @@ def split_document(filename: str) -> list[str]:
     if not content.strip():
         raise ValueError("文件内容为空，无法进行分割")
 
+    # 分割器先判断每段长度，合并时又会逐段再算一次：按文档缓存 token 数，
+    # 并且每一层的候选片段用 encode_ordinary_batch 一次算完，减少 Python 与 Rust 之间的往返
+    lengths = {}
+
+    def length_function(text: str) -> int:
+        n = lengths.get(text)
+        if n is None:
+            n = lengths[text] = token_length_function(text)
+        return n
+
+    def batch_length_function(texts: list[str]) -> list[int]:
+        missing = list({text for text in texts if text not in lengths})
+        if missing:
+            # 文件在进程池中并行分割，这里不再另开线程
+            for text, tokens in zip(missing, _ENC.encode_ordinary_batch(missing, num_threads=1)):
+                lengths[text] = len(tokens)
+        return [lengths[text] for text in texts]
+
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=300,
         chunk_overlap=50,
-        length_function=token_length_function,
+        length_function=length_function,
+        batch_length_function=batch_length_function,
         separators=None,
     )
     chunks = text_splitter.split_text(content)
@@ -97,10 +172,14 @@ class BaseAgentKnowledgeBase:
     子类只需定义各自的配置参数即可。
     """
 
-    def __init__(self, index_path: str, collection_name: str, dimension: int = 1024):
+    def __init__(self, index_path: str, collection_name: str, dimension: int = EMBED_DIM,
+                 use_fp16: bool = False, index_type: str = "flat", binary_first_stage: bool = False):
         self.index_path = index_path
         self.collection_name = collection_name
         self.dimension = dimension
+        self.use_fp16 = use_fp16  # 新建索引时以FP16存储向量
+        self.index_type = index_type  # 新建索引的类型：flat / hnsw / ivf_sq8 / ivf_pq，或 index_factory 描述串如 "HNSW32,SQ8"
+        self.binary_first_stage = binary_first_stage  # 同时建立二值索引，检索时先按汉明距离取候选再精确重打分（大语料）
         # 在这里调用内部方法
         self.vector_store = self._init_faiss_store(reset=False)
         self.model = self._load_embedding_model()
@@ -112,7 +191,10 @@ class BaseAgentKnowledgeBase:
                 index_path=self.index_path,
                 collection_name=self.collection_name,
                 dimension=self.dimension,
-                reset=reset
+                reset=reset,
+                use_fp16=self.use_fp16,
+                index_type=self.index_type,
+                binary_first_stage=self.binary_first_stage
             )
             print(f"初始化FAISS向量存储成功，集合名: {self.collection_name}，当前文档数量: {vector_store.count()}")
             return vector_store
@@ -124,66 +206,268 @@ class BaseAgentKnowledgeBase:
         import torch
         device = "cuda" if torch.cuda.is_available() else "cpu"
         try:
-            model = SentenceTransformer(
-                "./Qwen3-Embedding-0.6B",
-                device=device,
-                tokenizer_kwargs={"padding_side": "left"}
-            )
+            # GPU 上按 FP16 加载，CPU 上有 INT8 ONNX 文件时使用 ONNX Runtime
+            model = load_embedding_model("./Qwen3-Embedding-0.6B", device=device, trust_remote_code=False)
             print(f"嵌入模型加载成功，设备: {device}")
             return model
         except Exception as e:
             raise Exception(f"加载嵌入模型失败: {str(e)}")
 
-    def process_folder(self, folder_name: str, reset: bool = False):
+    def process_folder(self, folder_name: str, reset: bool = False, max_workers: int = None,
+                       flush_size: int = 2048, encode_batch_size: int = 64, use_processes: bool = True,
+                       encode_max_tokens: int = 16384, multi_gpu: bool = True):
         """
         处理指定文件夹中的所有文件，将其分割并存储到数据库。
+        默认增量更新：按清单中记录的修改时间和大小，只重新编码新增或修改过的文件，
+        已删除或修改过的文件对应的旧向量从索引中移除。
+
+        Args:
+            folder_name: 文件夹路径
+            reset: 是否先重置索引（全量重建）
+            max_workers: 并行读取和分割文件的进程（线程）数，默认为CPU核数
+            flush_size: 攒够多少个片段（跨文件）编码并写入一次索引，缓冲越大，
+                按 token 长度分桶的效果越好，GPU 空闲越少
+            encode_batch_size: 嵌入模型的批次大小（encode_max_tokens 为 None 时使用）
+            encode_max_tokens: 按 token 预算动态分批，每批 条数 × 最大长度 不超过该值
+            multi_gpu: 有多块GPU时启动 sentence-transformers 的多进程编码池，每批片段分片到所有GPU上并行编码
+            use_processes: 用进程池分割文件；分词和切分是纯 Python 的CPU计算，线程受 GIL 限制无法并行。
+                文件很少时可设为 False 改用线程池，省去子进程启动的开销
         """
         if not os.path.isdir(folder_name):
             raise NotADirectoryError(f"文件夹 {folder_name} 不存在或不是一个有效的文件夹")
 
+        manifest = {} if reset or self.vector_store.count() == 0 else self._load_manifest()
+        # 索引非空却没有清单时无法判断哪些文件已入库，只能全量重建
+        if not reset and self.vector_store.count() > 0 and not manifest:
+            print("索引缺少文件清单，将全量重建")
+            reset = True
+
+        # scandir 的目录项自带文件类型，不必再逐个 isfile；不支持的格式直接跳过
+        stats = {}
+        with os.scandir(folder_name) as entries:
+            for entry in entries:
+                if entry.is_file() and os.path.splitext(entry.name)[1] in SUPPORTED_EXTENSIONS:
+                    st = entry.stat()
+                    stats[entry.name] = {"mtime": st.st_mtime, "size": st.st_size}
+        all_files = sorted(stats)
+
+        # 与清单比较：未变化的文件跳过，修改过或已删除的文件的旧向量需要删除
+        if reset:
+            manifest = {}
+        stale = [name for name, entry in manifest.items()
+                 if name not in stats or (entry["mtime"], entry["size"]) != (stats[name]["mtime"], stats[name]["size"])]
+        removed = []
+        for name in stale:
+            removed.append(manifest.pop(name)["labels"])
+        # 去重时被跳过的片段依赖其他文件中的同内容片段：那些片段被移除（或当初写入失败）时，
+        # 依赖它们的文件也要重新处理，直到剩下的文件所依赖的内容都还在索引中
+        while True:
+            present = {h for entry in manifest.values() for h in entry.get("hashes", [])}
+            orphaned = [name for name, entry in manifest.items()
+                        if not present.issuperset(entry.get("dups", []))]
+            if not orphaned:
+                break
+            for name in orphaned:
+                removed.append(manifest.pop(name)["labels"])
+            stale.extend(orphaned)
+        to_remove = [label for start, end in removed for label in range(start, end)]
+        # 旧格式索引（如 HNSW）无法按ID删除：只有确实需要删除旧向量时才全量重建，只新增文件时照常追加
+        if to_remove and not self.vector_store.supports_removal:
+            print("索引不支持按ID删除，无法移除已修改或已删除文件的旧片段，将全量重建")
+            reset = True
+            manifest, stale, to_remove, present = {}, [], [], set()
         if reset:
             self.vector_store = self._init_faiss_store(reset=True)
-
-        all_files = [f for f in os.listdir(folder_name) if os.path.isfile(os.path.join(folder_name, f))]
-
-        if not all_files:
-            print(f"文件夹 {folder_name} 中没有找到任何文件")
+        elif to_remove:
+            # 一次性删除，索引和文本列表只重建一遍
+            self.vector_store.remove(to_remove, autosave=False)
+        seen = present  # 索引中已有片段的内容哈希，本次运行中新入队的片段也会加入
+        todo = [filename for filename in all_files if filename not in manifest]
+        if stale:
+            print(f"移除 {len(stale)} 个已修改或已删除文件的旧片段")
+
+        if not todo:
+            if stale:
+                self.vector_store.save()
+                self._save_manifest(manifest)
+            print(f"文件夹 {folder_name} 中没有需要处理的新文件或修改过的文件")
             return
 
-        print(f"开始处理文件夹 {folder_name}，共发现 {len(all_files)} 个文件")
+        print(f"开始处理文件夹 {folder_name}，共发现 {len(all_files)} 个文件，需要处理 {len(todo)} 个")
+
+        # 三级流水线，各级通过有界队列衔接，总耗时约等于最慢的一级：
+        #   1. 进程池并行读取和分割文件（PDF解析、分词），主线程把片段攒成批放入 encode_queue
+        #   2. 编码线程逐批编码（GPU），结果放入 write_queue
+        #   3. 写入线程把向量加入索引并记录清单
+        # 队列以 None 作为结束标记
+        encode_queue = queue.Queue(maxsize=4)
+        write_queue = queue.Queue(maxsize=4)
+        written = [0]
+
+        def encode_worker():
+            while True:
+                batch = encode_queue.get()
+                if batch is None:
+                    write_queue.put(None)
+                    return
+                chunks, ids, files = batch
+                if not chunks:  # 本批文件的片段全部重复，只需记入清单
+                    write_queue.put((chunks, ids, files, None))
+                    continue
+                try:
+                    if gpu_pool is not None:
+                        embeddings = np.ascontiguousarray(self.model.encode_multi_process(
+                            chunks,
+                            gpu_pool,
+                            batch_size=encode_batch_size,
+                            normalize_embeddings=True
+                        ), dtype=np.float32)
+                        write_queue.put((chunks, ids, files, embeddings))
+                        continue
+                    # 按 token 长度分桶编码，结果按原顺序返回，为连续的 float32 矩阵，FAISS 直接使用
+                    embeddings = encode_length_sorted(
+                        self.model,
+                        chunks,
+                        batch_size=encode_batch_size,
+                        max_tokens=encode_max_tokens,
+                        normalize_embeddings=True,  # 与检索时的查询向量保持一致
+                        show_progress_bar=False
+                    )
+                except Exception as e:
+                    print(f"编码片段时出错: {str(e)}，本批 {len(chunks)} 个片段将被跳过")
+                    continue
+                write_queue.put((chunks, ids, files, embeddings))
+
+        def write_worker():
+            while True:
+                batch = write_queue.get()
+                if batch is None:
+                    return
+                chunks, ids, files, embeddings = batch
+                try:
+                    labels = self.vector_store.add(
+                        documents=chunks,
+                        embeddings=embeddings,
+                        ids=ids,
+                        autosave=False
+                    ) if chunks else []
+                except Exception as e:
+                    print(f"写入片段时出错: {str(e)}，本批 {len(chunks)} 个片段将被跳过")
+                    continue
+                # 写入成功的文件才记入清单，失败的文件下次运行会重试
+                offset = 0
+                for filename, hashes, dups in files:
+                    n_chunks = len(hashes)
+                    label_range = [0, 0]  # 片段全部重复的文件没有自己的向量
+                    if n_chunks:
+                        label_range = [int(labels[offset]), int(labels[offset + n_chunks - 1]) + 1]
+                    manifest[filename] = {
+                        **stats[filename],
+                        "labels": label_range,
+                        "hashes": hashes,  # 本文件写入的片段的内容哈希
+                        "dups": dups  # 因与已有片段内容相同而跳过的片段哈希
+                    }
+                    offset += n_chunks
+                written[0] += len(chunks)
+
+        # 单GPU或CPU时多进程池没有收益（CPU 上的 ONNX/PyTorch 本身已多线程），只在多GPU时启用
+        gpu_pool = None
+        if multi_gpu and torch.cuda.device_count() > 1:
+            gpu_pool = self.model.start_multi_process_pool()
+            print(f"已启动多GPU编码池，GPU数量: {torch.cuda.device_count()}")
+
+        encoder = threading.Thread(target=encode_worker, daemon=True)
+        writer = threading.Thread(target=write_worker, daemon=True)
+        encoder.start()
+        writer.start()
+
+        pending_chunks = []
+        pending_ids = []
+        pending_files = []  # (文件名, 写入的片段哈希, 跳过的片段哈希)，同一文件的片段在批次中连续
+
+        def flush():
+            """把当前攒下的片段交给编码线程"""
+            encode_queue.put((pending_chunks[:], pending_ids[:], pending_files[:]))
+            pending_chunks.clear()
+            pending_ids.clear()
+            pending_files.clear()
 
-        total_chunks = 0
-        for file_idx, filename in enumerate(all_files, 1):
-            file_path = os.path.join(folder_name, filename)
-            try:
-                print(f"\n处理第 {file_idx}/{len(all_files)} 个文件: {filename}")
-                # 调用类外的辅助函数
-                chunks = split_document(file_path)
-                total_chunks += len(chunks)
-
-                embeddings = self.model.encode(chunks)
-
-                documents = []
-                embeddings_list = []
-                ids = []
-
-                for chunk_idx, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                    unique_id = f"file_{file_idx}_chunk_{chunk_idx}"
-                    documents.append(chunk)
-                    embeddings_list.append(embedding.tolist())
-                    ids.append(unique_id)
-
-                self.vector_store.add(
-                    documents=documents,
-                    embeddings=embeddings_list,
-                    ids=ids
-                )
-                print(f"文件 {filename} 处理完成，新增 {len(chunks)} 个片段")
-            except Exception as e:
-                print(f"处理文件 {filename} 时出错: {str(e)}，将跳过该文件")
-                continue
+        try:
+            workers = min(max_workers or os.cpu_count() or 1, len(todo))
+            if use_processes:
+                # spawn：主进程已启动编码/写入线程并可能初始化了CUDA，fork 不安全
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            else:
+                pool = ThreadPoolExecutor(max_workers=workers)
+            with pool:
+                futures = {
+                    pool.submit(split_document, os.path.join(folder_name, filename)): filename
+                    for filename in todo
+                }
+                for done, future in enumerate(as_completed(futures), 1):
+                    filename = futures[future]
+                    try:
+                        chunks = future.result()
+                    except Exception as e:
+                        print(f"处理文件 {filename} 时出错: {str(e)}，将跳过该文件")
+                        continue
+                    if not chunks:
+                        continue
+
+                    # 按内容哈希去重：与索引中或本次已入队片段完全相同的片段不再编码、不再写入
+                    hashes = []
+                    dups = []
+                    for chunk_idx, chunk in enumerate(chunks):
+                        digest = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).hexdigest()
+                        if digest in seen:
+                            dups.append(digest)
+                            continue
+                        seen.add(digest)
+                        hashes.append(digest)
+                        pending_chunks.append(chunk)
+                        # 片段ID按文件名和片段序号生成，增量更新后依然唯一
+                        pending_ids.append(f"{filename}_chunk_{chunk_idx}")
+                    pending_files.append((filename, hashes, sorted(set(dups))))
+                    print(f"已分割 {done}/{len(todo)} 个文件: {filename}，新增 {len(hashes)} 个片段"
+                          + (f"，跳过 {len(dups)} 个重复片段" if dups else ""))
+
+                    if len(pending_chunks) >= flush_size:
+                        flush()
+
+            if pending_files:
+                flush()
+        finally:
+            # 出错时也要让编码和写入线程退出，已写入的部分照常落盘
+            encode_queue.put(None)
+            encoder.join()
+            writer.join()
+            if gpu_pool is not None:
+                self.model.stop_multi_process_pool(gpu_pool)
+        total_chunks = written[0]
+
+        self.vector_store.save()
+        self._save_manifest(manifest)
+
+        print(f"\n所有文件处理完成，共处理 {len(todo)} 个文件，生成 {total_chunks} 个片段")
+
+    @property
+    def manifest_file(self) -> str:
+        """记录已入库文件的清单：文件名 -> 修改时间、大小、向量ID范围 [start, end) 以及写入和去重跳过的片段哈希"""
+        return os.path.join(self.index_path, f"{self.collection_name}.manifest.json")
+
+    def _load_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_file):
+            return {}
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"读取文件清单失败: {str(e)}")
+            return {}
 
-        print(f"\n所有文件处理完成，共处理 {len(all_files)} 个文件，生成 {total_chunks} 个片段")
+    def _save_manifest(self, manifest: dict):
+        with open(self.manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
 
 
 # 子类：为每个智能体定义具体的知识库
@@ -194,7 +478,7 @@ class PsychologyAssistant(BaseAgentKnowledgeBase):
         super().__init__(
             index_path="./faiss_index/psychology",
             collection_name="psychology_docs",
-            dimension=1024
+            dimension=EMBED_DIM
         )
 
 
@@ -205,7 +489,7 @@ class CampusQnA(BaseAgentKnowledgeBase):
         super().__init__(
             index_path="./faiss_index/campus",
             collection_name="campus_docs",
-            dimension=1024
+            dimension=EMBED_DIM
         )
 
 
@@ -216,7 +500,7 @@ class FitnessDietAssistant(BaseAgentKnowledgeBase):
         super().__init__(
             index_path="./faiss_index/fitness",
             collection_name="fitness_docs",
-            dimension=1024
+            dimension=EMBED_DIM
         )
 
 
@@ -227,7 +511,7 @@ class PaperAssistant(BaseAgentKnowledgeBase):
         super().__init__(
             index_path="./faiss_index/paper",
             collection_name="paper_docs",
-            dimension=1024
+            dimension=EMBED_DIM
         )
 
 
@@ -235,14 +519,14 @@ if __name__ == '__main__':
     # 开始处理心理助手知识库
     print("--- 开始处理心理助手知识库 ---")
     psychology_kb = PsychologyAssistant()
-    psychology_kb.process_folder(folder_name="psychology_docs", reset=True)
+    psychology_kb.process_folder(folder_name="psychology_docs")
 
     print("\n" + "=" * 50 + "\n")
     # 开始处理校园知识库
     print("--- 开始处理校园知识库 ---")
 
     campus_kb = CampusQnA()
-    campus_kb.process_folder(folder_name="campus_docs", reset=True)
+    campus_kb.process_folder(folder_name="campus_docs")
 
     print("\n" + "=" * 50 + "\n")
     
@@ -250,13 +534,13 @@ if __name__ == '__main__':
     # 开始处理健身饮食助手知识库
     print("--- 开始处理健身饮食助手知识库 ---")
     fitness_kb = FitnessDietAssistant()
-    fitness_kb.process_folder(folder_name="fitness_docs", reset=True)
+    fitness_kb.process_folder(folder_name="fitness_docs")
 
     print("\n" + "=" * 50 + "\n")
 
     # 开始处理论文助手知识库
     print("--- 开始处理论文助手知识库 ---")
     paper_kb = PaperAssistant()
-    paper_kb.process_folder(folder_name="paper_docs", reset=True)
+    paper_kb.process_folder(folder_name="paper_docs")
 
     print("\n所有知识库处理完成！")
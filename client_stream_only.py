@@ -1,6 +1,13 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import sseclient  # pip install sseclient-py
+try:
+    import orjson  # 可选：更快的 JSON 解析
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+_DATA_PREFIX = b"data: "
 
 class RAGStreamClient:
     """RAG流式API客户端"""
@@ -12,6 +19,11 @@ class RAGStreamClient:
             base_url: API服务器地址
         """
         self.base_url = base_url
+        # 复用同一个连接，后续请求不再重新握手
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
     
     def health_check(self) -> dict:
         """健康检查
@@ -19,7 +31,7 @@ class RAGStreamClient:
         Returns:
             dict: 服务状态信息
         """
-        response = requests.get(f"{self.base_url}/health")
+        response = self.session.get(f"{self.base_url}/health")
         return response.json()
     
     def query_stream(self, question: str):
@@ -33,28 +45,28 @@ class RAGStreamClient:
         """
         payload = {"query": question}
         
-        response = requests.post(
+        with self.session.post(
             f"{self.base_url}/query",
             json=payload,
             headers={"Content-Type": "application/json"},
             stream=True
-        )
-        
-        if response.status_code == 200:
-            client = sseclient.SSEClient(response)
-            for event in client.events():
-                if event.data:
-                    try:
-                        data = json.loads(event.data)
-                        if "error" in data:
-                            raise Exception(data["error"])
-                        if data["finished"]:
-                            break
-                        yield data["delta"]
-                    except json.JSONDecodeError:
-                        continue
-        else:
-            raise Exception(f"请求失败: {response.text}")
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"请求失败: {response.text}")
+
+            # 服务端每个事件只有一行 data，直接按行解析；chunk_size=None 时数据一到就返回
+            for raw in response.iter_lines(chunk_size=None):
+                if not raw.startswith(_DATA_PREFIX):
+                    continue
+                try:
+                    data = _loads(raw[len(_DATA_PREFIX):])
+                except ValueError:
+                    continue
+                if "error" in data:
+                    raise Exception(data["error"])
+                if data["finished"]:
+                    break
+                yield data["delta"]
     
     def simple_query_stream(self, question: str):
         """简化流式查询（纯文本格式）
@@ -65,18 +77,19 @@ class RAGStreamClient:
         Yields:
             str: 回答片段
         """
-        response = requests.post(
+        with self.session.post(
             f"{self.base_url}/query/simple",
             params={"query": question},
             stream=True
-        )
-        
-        if response.status_code == 200:
-            for chunk in response.iter_content(chunk_size=1, decode_unicode=True):
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"请求失败: {response.text}")
+
+            response.encoding = "utf-8"
+            # 按到达的数据块读取，不再逐字节读取
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
                 if chunk:
                     yield chunk
-        else:
-            raise Exception(f"请求失败: {response.text}")
 
 # 使用示例
 if __name__ == "__main__":
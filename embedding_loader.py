@@ -0,0 +1,204 @@
+import os
+
+# CPU 推理的线程数：默认用满所有核心（部分环境下 PyTorch/OpenMP 默认只开一个线程）；
+# 已设置的环境变量优先。OpenMP/MKL 在 torch 首次导入时读取，必须在导入前设置，
+# 因此各入口模块应先导入本模块再导入 torch；已先导入 torch 时下面的 set_num_threads 仍然生效
+CPU_THREADS = int(os.getenv("OMP_NUM_THREADS") or os.cpu_count() or 1)
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_THREADS))
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+torch.set_num_threads(CPU_THREADS)
+try:
+    torch.set_num_interop_threads(2)
+except RuntimeError:  # 已经执行过并行计算后不能再修改
+    pass
+
+# CPU 上使用的动态 INT8 量化 ONNX 文件（相对模型目录），由 export_int8_onnx 生成
+ONNX_INT8_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+# 重排用的交叉编码器目录，可用环境变量 CHUNKIT_CROSS_ENCODER 替换。
+# 只有CPU的部署建议换成层数少的多语言模型（如 mMiniLM 系列的 cross-encoder/mmarco-mMiniLMv2-L12-H384-v1），
+# 重排耗时随层数线性下降；英文的 ms-marco-MiniLM 不适合本项目的中文文档
+CROSS_ENCODER_PATH = os.getenv("CHUNKIT_CROSS_ENCODER", "./cross-encoder-model")
+
+# 新建索引的向量维度：Qwen3-Embedding 以 Matryoshka 方式训练，取前 EMBED_DIM 维再归一化仍可直接用于检索，
+# 256 维时 FAISS 的距离计算和索引体积约为完整 1024 维的 1/4，召回损失很小。
+# 嵌入模型本身按完整维度输出，由 FAISSVectorStore 在写入和查询时截断到磁盘上索引的维度，
+# 因此按完整维度建立的旧索引无需重建即可继续使用
+EMBED_DIM = int(os.getenv("CHUNKIT_EMBED_DIM", "256"))
+
+# 设置 CHUNKIT_TORCH_COMPILE=1 时用 torch.compile（TorchInductor）编译 PyTorch 后端的前向计算，
+# 融合注意力/LayerNorm 等算子、减少短序列上的 Python 调度开销；首次推理需要额外的编译时间
+TORCH_COMPILE = os.getenv("CHUNKIT_TORCH_COMPILE") == "1"
+
+
+def _maybe_compile(module: torch.nn.Module, device: str) -> torch.nn.Module:
+    """按 TORCH_COMPILE 编译模块；torch<2.0 或编译失败时原样返回（eager 执行）
+
+    dynamic=True 避免每种序列长度都重新编译；CUDA 上用 reduce-overhead 模式（CUDA Graphs）省去逐个 kernel 的启动开销
+    """
+    if not TORCH_COMPILE or not hasattr(torch, "compile"):
+        return module
+    mode = "reduce-overhead" if device.startswith("cuda") else "default"
+    try:
+        return torch.compile(module, mode=mode, dynamic=True)
+    except Exception as e:
+        print(f"torch.compile 失败: {e}，使用 eager 模式")
+        return module
+
+
+def load_embedding_model(model_path: str = "./Qwen3-Embedding-0.6B", device: str = None,
+                         trust_remote_code: bool = True,
+                         truncate_dim: int = None) -> SentenceTransformer:
+    """加载嵌入模型，调用方拿到的始终是带 .encode 的 SentenceTransformer
+
+    - CUDA：以 FP16 加载权重，显存减半，线性层走 Tensor Core
+    - CPU：模型目录下已有 INT8 量化的 ONNX 文件时使用 ONNX Runtime 后端，否则按 FP32 加载
+    设置环境变量 CHUNKIT_EMBED_FP32=1 可强制按原始精度加载
+    truncate_dim: encode 输出的维度（sentence-transformers>=2.7 先截断再归一化），默认 None 输出完整维度；
+        检索和建库都应保持默认，由向量存储按各自索引的维度截断（同一个模型可以服务不同维度的索引）
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    kwargs = dict(
+        device=device,
+        tokenizer_kwargs={"padding_side": "left"},
+        trust_remote_code=trust_remote_code,
+        truncate_dim=truncate_dim
+    )
+
+    if os.getenv("CHUNKIT_EMBED_FP32") != "1":
+        if device.startswith("cuda"):
+            model = SentenceTransformer(model_path, model_kwargs={"torch_dtype": torch.float16}, **kwargs).eval()
+            model[0].auto_model = _maybe_compile(model[0].auto_model, device)
+            return model
+
+        if os.path.exists(os.path.join(model_path, ONNX_INT8_FILE)):
+            try:
+                return SentenceTransformer(
+                    model_path, backend="onnx",
+                    model_kwargs={"file_name": ONNX_INT8_FILE, "provider": "CPUExecutionProvider"},
+                    **kwargs
+                )
+            except Exception as e:  # 旧版 sentence-transformers 或未安装 optimum/onnxruntime
+                print(f"加载INT8 ONNX嵌入模型失败: {e}，改用PyTorch FP32")
+
+    model = SentenceTransformer(model_path, **kwargs).eval()
+    model[0].auto_model = _maybe_compile(model[0].auto_model, device)
+    return model
+
+
+def load_cross_encoder(model_path: str = CROSS_ENCODER_PATH, device: str = None,
+                       max_length: int = 256) -> CrossEncoder:
+    """加载重排用的交叉编码器
+
+    - PyTorch 后端加载后即切换到 eval 模式（retrieve_model 的预分词路径直接调用底层模型，不经过 predict）
+    - 截断到 max_length 个 token，知识库片段本身不长，避免少数长片段把整批 padding 拉长
+    - CUDA：权重转为 FP16；CHUNKIT_EMBED_FP32=1 时保持原始精度
+    - CPU：模型目录下已有 INT8 量化的 ONNX 文件时使用 ONNX Runtime 后端（sentence-transformers>=4.1）
+    """
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    if os.getenv("CHUNKIT_EMBED_FP32") != "1":
+        if device.startswith("cuda"):
+            cross_encoder = CrossEncoder(model_path, device=device, max_length=max_length)
+            cross_encoder.model.half().eval()
+            cross_encoder.model = _maybe_compile(cross_encoder.model, device)
+            return cross_encoder
+
+        if os.path.exists(os.path.join(model_path, ONNX_INT8_FILE)):
+            try:
+                return CrossEncoder(
+                    model_path, device=device, max_length=max_length, backend="onnx",
+                    model_kwargs={"file_name": ONNX_INT8_FILE, "provider": "CPUExecutionProvider"}
+                )
+            except Exception as e:  # 旧版 sentence-transformers 的 CrossEncoder 不支持 backend 参数
+                print(f"加载INT8 ONNX交叉编码器失败: {e}，改用PyTorch FP32")
+
+    cross_encoder = CrossEncoder(model_path, device=device, max_length=max_length)
+    cross_encoder.model.eval()
+    cross_encoder.model = _maybe_compile(cross_encoder.model, device)
+    return cross_encoder
+
+
+def encode_float32(model: SentenceTransformer, texts, **kwargs) -> np.ndarray:
+    """编码文本，返回 shape 为 (N, dim) 的 C 连续 float32 矩阵，可直接交给 FAISS
+
+    以张量形式取回后一次性转成 float32 再拷到主机，避免逐条转 numpy 再堆叠，
+    FP16 模型的输出也只转换一次，下游的 np.ascontiguousarray 不会再复制
+    """
+    with torch.inference_mode():
+        emb = model.encode(texts, convert_to_tensor=True, **kwargs)
+    emb = emb.to(torch.float32).cpu().numpy().reshape(len(texts), -1)
+    assert emb.dtype == np.float32 and emb.flags.c_contiguous
+    return emb
+
+
+def encode_length_sorted(model: SentenceTransformer, texts, batch_size: int = 64,
+                         max_tokens: int = None, **kwargs) -> np.ndarray:
+    """按分词后的长度分桶编码，返回与 texts 顺序一致的 float32 矩阵
+
+    encode 内部按字符数排序，与实际 token 数并不一致；这里用模型自己的分词器算长度，
+    按长度降序分批逐批编码（同批长度相近，padding 最少），再按原顺序写回结果矩阵，
+    调用方的 ID 与向量依然一一对应
+
+    max_tokens: 按 token 预算分批：每批的 条数 × 批内最大长度 不超过该值，
+        短文本一批多放、长文本一批少放，显存占用和每步计算量保持平稳；不设置时每批固定 batch_size 条
+    """
+    if len(texts) == 0:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    lens = np.fromiter(
+        (len(ids) for ids in model.tokenizer(list(texts), add_special_tokens=False)["input_ids"]),
+        dtype=np.int64, count=len(texts)
+    )
+    if model.max_seq_length:
+        np.minimum(lens, model.max_seq_length, out=lens)  # 超长文本会被截断，按截断后的长度计
+    order = np.argsort(-lens, kind="stable")
+
+    if max_tokens is None:
+        batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    else:
+        # 降序排列，每批第一条就是批内最长的
+        batches = []
+        start = 0
+        while start < len(order):
+            size = max(1, int(max_tokens // max(int(lens[order[start]]), 1)))
+            batches.append(order[start:start + size])
+            start += size
+
+    out = None
+    for idx in batches:
+        emb = encode_float32(model, [texts[i] for i in idx], batch_size=len(idx), **kwargs)
+        if out is None:
+            out = np.empty((len(texts), emb.shape[1]), dtype=np.float32)
+        out[idx] = emb
+    return out
+
+
+def export_int8_onnx(model_path: str = "./Qwen3-Embedding-0.6B", trust_remote_code: bool = True) -> str:
+    """导出嵌入模型的 ONNX 模型并做动态 INT8 量化，结果写入模型目录，供 CPU 推理使用（只需运行一次）"""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(model_path, backend="onnx", device="cpu",
+                                trust_remote_code=trust_remote_code)
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", model_path)
+    print(f"INT8 ONNX嵌入模型已导出: {os.path.join(model_path, ONNX_INT8_FILE)}")
+    return os.path.join(model_path, ONNX_INT8_FILE)
+
+
+def export_cross_encoder_int8_onnx(model_path: str = CROSS_ENCODER_PATH) -> str:
+    """导出交叉编码器的 ONNX 模型并做动态 INT8 量化（需要 sentence-transformers>=4.1 和 optimum[onnxruntime]）"""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    model = CrossEncoder(model_path, backend="onnx", device="cpu")
+    export_dynamic_quantized_onnx_model(model, "avx512_vnni", model_path)
+    print(f"INT8 ONNX交叉编码器已导出: {os.path.join(model_path, ONNX_INT8_FILE)}")
+    return os.path.join(model_path, ONNX_INT8_FILE)
+
+
+if __name__ == "__main__":
+    export_int8_onnx()
+    export_cross_encoder_int8_onnx()
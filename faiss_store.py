@@ -1,30 +1,109 @@
 import os
+import json
 import pickle
+from embedding_loader import EMBED_DIM  # 先于 numpy/faiss/torch 导入，线程数设置才能生效
 import numpy as np
 import faiss
 from typing import List, Dict, Any, Optional, Tuple
 import torch
 from sentence_transformers import SentenceTransformer
 
+# FAISS 检索使用自己的 OpenMP 线程池：默认取一半逻辑核（约为物理核数），与同进程里的 PyTorch 推理错开，
+# 全部核心都给 FAISS 时单个查询的并行开销反而更大；可用 CHUNKIT_FAISS_THREADS 覆盖
+FAISS_THREADS = int(os.getenv("CHUNKIT_FAISS_THREADS") or max(1, (os.cpu_count() or 2) // 2))
+faiss.omp_set_num_threads(FAISS_THREADS)
+
+# GPU 检索的临时显存上限；默认值会预留显存的很大一部分，与同卡上的嵌入模型和交叉编码器争抢
+GPU_TEMP_MEMORY = 256 * 1024 * 1024
+
+# faiss-gpu 才有 GPU 资源类；torch_utils 让 search 直接接受 torch 张量（包括 CUDA 张量，省去拷回主机）
+FAISS_GPU_AVAILABLE = hasattr(faiss, "StandardGpuResources")
+if FAISS_GPU_AVAILABLE:
+    try:
+        import faiss.contrib.torch_utils  # noqa: F401
+        TORCH_SEARCH_AVAILABLE = True
+    except ImportError:
+        TORCH_SEARCH_AVAILABLE = False
+else:
+    TORCH_SEARCH_AVAILABLE = False
+
 class FAISSVectorStore:
     """FAISS向量存储类，替代ChromaDB"""
     
     def __init__(self, 
                  index_path: str = "./faiss_index", 
                  collection_name: str = "document_embeddings",
-                 dimension: int = 1024,
-                 reset: bool = False):
+                 dimension: int = EMBED_DIM,
+                 reset: bool = False,
+                 use_fp16: bool = False,
+                 index_type: str = "flat",
+                 hnsw_m: int = 32,
+                 ef_search: int = 64,
+                 nlist: Optional[int] = None,
+                 nprobe: int = 16,
+                 pq_m: int = 64,
+                 pq_nbits: int = 8,
+                 train_size: int = 100_000,
+                 use_gpu: bool = False,
+                 mmap: bool = False,
+                 binary_first_stage: bool = False,
+                 rescore_k: int = 200):
         """初始化FAISS向量存储
         
         Args:
             index_path: FAISS索引文件保存路径
             collection_name: 集合名称
-            dimension: 向量维度，Qwen3-0.6B的固定维度为1024
+            dimension: 向量维度，默认与嵌入模型截断后的维度 EMBED_DIM 一致（Qwen3-0.6B 完整维度为1024）；
+                加载已有索引时以文件中的维度为准
             reset: 是否重置索引
+            use_fp16: 新建索引时以FP16标量量化存储向量，内存和索引文件减半（flat 和 hnsw；IVF 类型本身已量化）
+            index_type: 新建索引的类型："flat" 精确检索；"hnsw" 图索引近似检索；
+                "ivf_sq8" 倒排 + int8 标量量化，内存约为 flat 的1/4；
+                "ivf_pq" 倒排 + 乘积量化，每个向量只占 pq_m 字节（1024维时为 flat 的1/64），适合百万级以上；
+                也可以直接传 FAISS index_factory 描述串，如 "HNSW32,SQ8"（int8 标量量化的图索引）。
+                均按内积度量，要求写入和查询的向量已归一化（此时等价于余弦相似度）。
+                加载已有索引时以文件中的类型和度量为准（旧版 flat 索引为L2距离，对归一化向量排序结果相同）
+            hnsw_m: HNSW 每个节点的邻居数
+            ef_search: HNSW 检索时的候选队列长度
+            nlist: IVF 聚类中心数，默认按训练样本数取 4*sqrt(N)（样本不足时自动减小）
+            nprobe: IVF 检索时访问的聚类数
+            pq_m: IVFPQ 的子空间数，需整除 dimension
+            pq_nbits: IVFPQ 每个子空间的编码位数
+            train_size: IVF 攒够多少向量后训练，最多用这么多向量训练
+            use_gpu: 安装了 faiss-gpu 时把索引复制到 GPU 上检索（写入仍在 CPU 索引上进行，落盘格式不变）
+            mmap: 以只读内存映射方式加载已有索引（IVF 的倒排表直接映射索引文件），启动时不必整体读入内存，
+                多个服务进程共享同一份页缓存；这样加载的索引只能检索，不能 add/remove
+            binary_first_stage: 新建索引时同时维护一份二值化（每维1 bit，按符号量化）的 HNSW 索引：
+                检索先按汉明距离取 rescore_k 个候选，再用主索引中的向量精确计算内积取前 n_results 个，
+                第一阶段的内存约为 float32 的 1/32。要求主索引能取回向量（flat / hnsw，不支持 IVF）
+                且按内积度量（旧格式的 L2 索引不启用，否则两条检索路径返回的分数含义不同）。
+                加载时索引目录下有二值索引文件就自动启用
+            rescore_k: 二值索引第一阶段的候选数
         """
         self.index_path = index_path
         self.collection_name = collection_name
         self.dimension = dimension
+        self.use_fp16 = use_fp16
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.train_size = train_size
+        self._untrained = []  # IVF 训练前暂存的 (向量, 向量ID)
+        self.use_gpu = use_gpu and FAISS_GPU_AVAILABLE and torch.cuda.is_available()
+        self._gpu_res = None
+        self._gpu_index = None
+        self._gpu_key = None  # (CPU索引对象, 版本号)：CPU 索引变化后重新复制
+        self._version = 0
+        self.mmap = mmap
+        self._mmapped = False
+        self.binary_first_stage = binary_first_stage
+        self.rescore_k = rescore_k
+        self.binary_index = None
+        self._binary_dirty = False  # 删除后二值索引待重建（HNSW 二值索引不支持删除）
         
         # 创建索引目录
         os.makedirs(index_path, exist_ok=True)
@@ -33,6 +112,9 @@ class FAISSVectorStore:
         self.index_file = os.path.join(index_path, f"{collection_name}.index")
         self.documents_file = os.path.join(index_path, f"{collection_name}.documents")
         self.ids_file = os.path.join(index_path, f"{collection_name}.ids")
+        self.labels_file = os.path.join(index_path, f"{collection_name}.labels")
+        self.binary_file = os.path.join(index_path, f"{collection_name}.bindex")
+        self.search_params_file = os.path.join(index_path, f"{collection_name}.search.json")  # tune_faiss.py 的调参结果
         
         # 初始化或加载索引
         if reset or not os.path.exists(self.index_file):
@@ -44,88 +126,429 @@ class FAISSVectorStore:
     
     def _create_new_index(self):
         """创建新的FAISS索引"""
-        # 创建L2距离的索引
-        self.index = faiss.IndexFlatL2(self.dimension)
+        if self.index_type == "hnsw" and self.use_fp16:
+            # 图结构不变，节点向量以FP16存储
+            base = faiss.IndexHNSWSQ(
+                self.dimension, faiss.ScalarQuantizer.QT_fp16, self.hnsw_m, faiss.METRIC_INNER_PRODUCT
+            )
+            base.hnsw.efConstruction = 200
+        elif self.index_type == "hnsw":
+            base = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            base.hnsw.efConstruction = 200
+        elif self.index_type in ("ivf_sq8", "ivf_pq"):
+            base = self._new_ivf_index(self.nlist or 1)  # 聚类数在训练时按样本数确定
+        elif "," in self.index_type:
+            # FAISS index_factory 描述串，如 "HNSW32,SQ8"、"IVF1024,SQ8"、"HNSW32,SQfp16"
+            base = faiss.index_factory(self.dimension, self.index_type, faiss.METRIC_INNER_PRODUCT)
+            if isinstance(base, faiss.IndexHNSW):
+                base.hnsw.efConstruction = 200
+        elif self.index_type != "flat":
+            raise ValueError(f"不支持的索引类型: {self.index_type}")
+        elif self.use_fp16:
+            # FP16 标量量化不需要训练，距离仍按 float32 计算
+            base = faiss.IndexScalarQuantizer(
+                self.dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            # 向量已归一化，内积即余弦相似度，检索就是一次矩阵乘（sgemm）
+            base = faiss.IndexFlatIP(self.dimension)
+        # 外面包一层 IDMap2：向量ID在删除后保持不变，支持按文件增量更新
+        self.index = faiss.IndexIDMap2(base)
+        self.binary_index = None
+        self._binary_dirty = False
+        if self.binary_first_stage:
+            reason = self._binary_unsupported_reason()
+            if reason:
+                print(f"{reason}，不启用二值索引第一阶段")
+            else:
+                self.binary_index = self._new_binary_index()
+        self._apply_search_params()
+        self._untrained = []
         self.documents = []
         self.ids = []
-        print(f"创建新的FAISS索引，维度: {self.dimension}")
+        self.labels = []
+        self._positions = {}
+        self._saved_count = None  # 已写入文档文件的条数；None 表示下次保存时整体重写
+        self._mmapped = False
+        print(f"创建新的FAISS索引，类型: {self.index_type}，维度: {self.dimension}")
+
+    def _new_ivf_index(self, nlist: int, index_type: Optional[str] = None):
+        """创建未训练的 IVF 索引：int8 标量量化（ivf_sq8）或乘积量化（ivf_pq）"""
+        quantizer = faiss.IndexFlatIP(self.dimension)
+        if (index_type or self.index_type) == "ivf_pq":
+            return faiss.IndexIVFPQ(
+                quantizer, self.dimension, nlist, self.pq_m, self.pq_nbits, faiss.METRIC_INNER_PRODUCT
+            )
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer, self.dimension, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+        return index
+
+    def _new_binary_index(self):
+        """每维 1 bit 的 HNSW 二值索引（汉明距离），外包 IDMap2 与主索引共用向量ID"""
+        if self.dimension % 8:
+            raise ValueError(f"二值索引要求维度是8的倍数，当前为 {self.dimension}")
+        base = faiss.IndexBinaryHNSW(self.dimension, self.hnsw_m)
+        return faiss.IndexBinaryIDMap2(base)
+
+    def _binary_unsupported_reason(self) -> Optional[str]:
+        """主索引不适合做二值索引的重打分时返回原因，否则返回 None"""
+        if self.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            return "主索引不是内积度量（如旧格式的 L2 索引），重打分的内积与其距离不一致"
+        if isinstance(self._base_index(), faiss.IndexIVF):
+            return "IVF 索引不能取回原始向量"
+        return None
+
+    @staticmethod
+    def _binarize(x: np.ndarray) -> np.ndarray:
+        """按符号二值化并按位打包：归一化向量以 0 为阈值，每 8 维一个字节"""
+        return np.packbits(x > 0, axis=1)
+
+    def _rebuild_binary_index(self):
+        """从主索引取回现有向量重建二值索引（HNSW 二值索引不支持删除）"""
+        binary = self._new_binary_index()
+        if self.labels:
+            labels = np.asarray(self.labels, dtype=np.int64)
+            for start in range(0, len(labels), 65536):
+                chunk = labels[start:start + 65536]
+                binary.add_with_ids(self._binarize(self.index.reconstruct_batch(chunk)), chunk)
+        self.binary_index = binary
+        self._binary_dirty = False
+
+    def _base_index(self):
+        """IDMap 包装下的实际索引"""
+        if isinstance(self.index, faiss.IndexIDMap):
+            return faiss.downcast_index(self.index.index)
+        return self.index
+
+    def _load_tuned_params(self):
+        """读取 tune_faiss.py 针对该索引调出的 efSearch/nprobe，覆盖构造参数"""
+        if not os.path.exists(self.search_params_file):
+            return
+        try:
+            with open(self.search_params_file, 'r', encoding='utf-8') as f:
+                tuned = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取检索参数文件失败: {str(e)}，使用默认参数")
+            return
+        self.ef_search = int(tuned.get("ef_search", self.ef_search))
+        self.nprobe = int(tuned.get("nprobe", self.nprobe))
+        print(f"使用调参结果: ef_search={self.ef_search}, nprobe={self.nprobe}")
+
+    def _apply_search_params(self):
+        """设置检索参数（efSearch/nprobe 不一定随索引文件保存，加载后重新设置）"""
+        base = self._base_index()
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = self.ef_search
+        elif isinstance(base, faiss.IndexIVF):
+            base.nprobe = min(self.nprobe, base.nlist)
+
+    @property
+    def supports_removal(self) -> bool:
+        """是否支持按向量ID删除（旧格式的无ID索引和 HNSW 不支持）"""
+        return isinstance(self.index, faiss.IndexIDMap) and not isinstance(self._base_index(), faiss.IndexHNSW)
+
+    def _rebuild_positions(self):
+        self._positions = {label: pos for pos, label in enumerate(self.labels)}
+
+    def _train_pending(self):
+        """用暂存的向量训练索引（IVF 或需要训练的标量量化索引）并写入"""
+        if not self._untrained:
+            return
+        x = np.vstack([vectors for vectors, _ in self._untrained])
+        labels = np.concatenate([labels for _, labels in self._untrained])
+        n = len(x)
+        detail = ""
+        # index_factory 构建的索引按描述串原样训练；内置的 IVF 类型按样本数调整聚类数
+        if isinstance(self._base_index(), faiss.IndexIVF) and "," not in self.index_type:
+            # 每个聚类中心至少需要约39个训练样本，样本不足时减少聚类数
+            nlist = min(self.nlist or int(4 * np.sqrt(n)), max(1, n // 39))
+            current_type = "ivf_pq" if isinstance(self._base_index(), faiss.IndexIVFPQ) else "ivf_sq8"
+            index_type = current_type
+            if index_type == "ivf_pq" and n < 2 ** self.pq_nbits:
+                # 乘积量化的码本需要至少 2^nbits 个样本，向量太少时改用 int8 标量量化
+                print(f"向量数量 {n} 不足以训练乘积量化，改用 ivf_sq8")
+                index_type = "ivf_sq8"
+            if nlist != self._base_index().nlist or index_type != current_type:
+                self.index = faiss.IndexIDMap2(self._new_ivf_index(nlist, index_type))
+            detail = f"聚类数: {nlist}，"
+        sample = x
+        if n > self.train_size:
+            sample = x[np.random.default_rng(0).choice(n, self.train_size, replace=False)]
+        self.index.train(sample)
+        self.index.add_with_ids(x, labels)
+        self._untrained = []
+        self._version += 1
+        self._apply_search_params()
+        print(f"索引训练完成，{detail}训练样本: {len(sample)}")
     
     def _load_index(self):
         """加载现有的FAISS索引"""
         try:
-            self.index = faiss.read_index(self.index_file)
+            self.index = None
+            if self.mmap:
+                try:
+                    self.index = faiss.read_index(self.index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                    self._mmapped = True
+                except Exception as e:  # 该索引类型或 FAISS 版本不支持内存映射
+                    print(f"内存映射方式加载索引失败: {str(e)}，改为读入内存")
+            if self.index is None:
+                self.index = faiss.read_index(self.index_file)
+            if self.index.d != self.dimension:
+                print(f"索引文件的维度为 {self.index.d}，与设置的 {self.dimension} 不一致，按索引文件的维度使用")
+                self.dimension = self.index.d
+            self._load_tuned_params()
+            self._apply_search_params()
+            self.binary_index = None
+            self._binary_dirty = False
+            if os.path.exists(self.binary_file) or self.binary_first_stage:
+                reason = self._binary_unsupported_reason()
+                if reason:
+                    print(f"{reason}，不启用二值索引第一阶段")
+                elif os.path.exists(self.binary_file):
+                    self.binary_index = faiss.read_index_binary(self.binary_file)
             
-            with open(self.documents_file, 'rb') as f:
-                self.documents = pickle.load(f)
-                
-            with open(self.ids_file, 'rb') as f:
-                self.ids = pickle.load(f)
+            self.documents = self._read_log(self.documents_file)
+            self.ids = self._read_log(self.ids_file)
+
+            # 旧格式没有向量ID文件，向量ID就是位置
+            if os.path.exists(self.labels_file):
+                self.labels = self._read_log(self.labels_file)
+                self._saved_count = len(self.documents)
+            else:
+                self.labels = list(range(len(self.documents)))
+                self._saved_count = None  # 下次保存时整体重写，补上向量ID文件
+            self._rebuild_positions()
+            self._untrained = []
+            if (self.binary_index is None and self.binary_first_stage and not self._mmapped
+                    and self._binary_unsupported_reason() is None):
+                self._rebuild_binary_index()
                 
             print(f"成功加载FAISS索引，包含{len(self.documents)}个文档")
         except Exception as e:
             print(f"加载索引失败: {str(e)}，将创建新索引")
             self._create_new_index()
     
+    @staticmethod
+    def _read_log(path: str) -> list:
+        """读取由若干个 pickle 列表依次拼接成的文件（旧格式只有一个列表，读法相同）"""
+        items = []
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    items.extend(pickle.load(f))
+                except EOFError:
+                    return items
+
     def save(self):
-        """保存索引和相关数据"""
+        """保存索引和相关数据
+
+        文档、ID和向量ID文件只追加上次保存之后新增的部分，不再每次重写全部内容；
+        删除或重置之后才整体重写
+        """
         try:
+            self._train_pending()
             faiss.write_index(self.index, self.index_file)
-            
-            with open(self.documents_file, 'wb') as f:
-                pickle.dump(self.documents, f)
-                
-            with open(self.ids_file, 'wb') as f:
-                pickle.dump(self.ids, f)
+            if self._binary_dirty:
+                self._rebuild_binary_index()  # 本次保存前的所有删除合并为一次重建
+            if self.binary_index is not None:
+                faiss.write_index_binary(self.binary_index, self.binary_file)
+            elif os.path.exists(self.binary_file):
+                os.remove(self.binary_file)  # 重置后未启用二值索引，旧文件与主索引不再对应
+
+            start = self._saved_count
+            mode = 'ab' if start is not None and start <= len(self.documents) else 'wb'
+            if mode == 'wb':
+                start = 0
+            if mode == 'wb' or start < len(self.documents):
+                for path, items in ((self.documents_file, self.documents),
+                                    (self.ids_file, self.ids),
+                                    (self.labels_file, self.labels)):
+                    with open(path, mode) as f:
+                        pickle.dump(items[start:], f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._saved_count = len(self.documents)
                 
             print(f"FAISS索引保存成功，文档数量: {len(self.documents)}")
         except Exception as e:
             raise Exception(f"保存FAISS索引失败: {str(e)}")
     
-    def add(self, documents: List[str], embeddings: List[List[float]], ids: List[str]):
+    def add(self, documents: List[str], embeddings, ids: List[str], autosave: bool = True):
         """添加文档和向量到索引
         
         Args:
             documents: 文档内容列表
-            embeddings: 向量列表
+            embeddings: 向量矩阵 (np.ndarray, shape为(N, dimension))；C 连续的 float32 矩阵原样交给 FAISS，
+                不复制，其他 dtype 或向量列表会先转换一次；维度大于索引维度时取前 dimension 维并重新归一化
             ids: 文档ID列表
+            autosave: 添加后立即写盘；批量导入时可设为False，结束后统一调用save()
+
+        Returns:
+            np.ndarray: 分配给这些文档的向量ID (int64)，可用于 remove
         """
-        if not documents or not embeddings or not ids:
+        if self._mmapped:
+            raise RuntimeError("以内存映射方式加载的索引是只读的，请以 mmap=False 打开后再写入")
+        if not documents or len(embeddings) == 0 or not ids:
             raise ValueError("文档、向量和ID不能为空")
             
         if len(documents) != len(embeddings) or len(documents) != len(ids):
             raise ValueError("文档、向量和ID数量必须一致")
         
-        # 转换为numpy数组
-        embeddings_np = np.array(embeddings).astype('float32')
+        # FAISS 只接受连续的 float32 矩阵，已经满足时不会复制
+        embeddings_np = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings_np.ndim == 2 and embeddings_np.shape[1] > self.dimension:
+            embeddings_np = self._truncate_queries(embeddings_np)  # 完整维度的向量按 Matryoshka 截断到索引维度
+        if embeddings_np.ndim != 2 or embeddings_np.shape[1] != self.dimension:
+            raise ValueError(f"向量维度 {embeddings_np.shape[1:]} 与索引维度 {self.dimension} 不一致，"
+                             f"请检查 CHUNKIT_EMBED_DIM 或以 reset=True 重建索引")
         
-        # 添加到索引
-        self.index.add(embeddings_np)
+        start = self.labels[-1] + 1 if self.labels else 0
+        labels = np.arange(start, start + len(documents), dtype=np.int64)
+
+        # 添加到索引；IVF 尚未训练时先暂存，攒够样本后统一训练
+        if not self.index.is_trained:
+            self._untrained.append((embeddings_np, labels))
+            if sum(len(x) for x, _ in self._untrained) >= self.train_size:
+                self._train_pending()
+        elif isinstance(self.index, faiss.IndexIDMap):
+            self.index.add_with_ids(embeddings_np, labels)
+        else:
+            self.index.add(embeddings_np)  # 旧格式索引：向量ID即位置，与 labels 一致
+        if self.binary_index is not None and not self._binary_dirty:  # 待重建时新向量随重建一起加入
+            self.binary_index.add_with_ids(self._binarize(embeddings_np), labels)
         
         # 保存文档和ID
         self.documents.extend(documents)
         self.ids.extend(ids)
+        new_labels = labels.tolist()
+        self._positions.update(zip(new_labels, range(len(self.labels), len(self.labels) + len(new_labels))))
+        self.labels.extend(new_labels)
         
         # 自动保存
-        self.save()
+        self._version += 1
+        if autosave:
+            self.save()
+        return labels
+
+    def remove(self, labels, autosave: bool = True) -> int:
+        """按向量ID删除文档
+
+        Args:
+            labels: add 返回的向量ID
+            autosave: 删除后立即写盘
+
+        Returns:
+            int: 实际删除的数量
+        """
+        if self._mmapped:
+            raise RuntimeError("以内存映射方式加载的索引是只读的，请以 mmap=False 打开后再写入")
+        if not self.supports_removal:
+            raise RuntimeError("当前索引不支持删除，请重建索引")
+        # 先把暂存的向量写入索引，删除才能生效
+        self._train_pending()
+
+        to_remove = set(int(label) for label in labels) & self._positions.keys()
+        if not to_remove:
+            return 0
+        self.index.remove_ids(np.fromiter(to_remove, dtype=np.int64, count=len(to_remove)))
+
+        keep = [pos for pos, label in enumerate(self.labels) if label not in to_remove]
+        self.documents = [self.documents[pos] for pos in keep]
+        self.ids = [self.ids[pos] for pos in keep]
+        self.labels = [self.labels[pos] for pos in keep]
+        self._rebuild_positions()
+        if self.binary_index is not None:
+            self._binary_dirty = True  # 推迟到保存或下次检索时重建，连续多次删除只重建一遍
+        self._version += 1
+        self._saved_count = None  # 已落盘的内容有删除，不能再追加
+
+        if autosave:
+            self.save()
+        return len(to_remove)
+
+    def _search_index(self):
+        """检索使用的索引：启用GPU时返回与CPU索引同步的GPU副本"""
+        if not self.use_gpu:
+            return self.index
+        key = (self.index, self._version)
+        if self._gpu_key != key:
+            try:
+                if self._gpu_res is None:
+                    self._gpu_res = faiss.StandardGpuResources()
+                    self._gpu_res.setTempMemory(GPU_TEMP_MEMORY)
+                self._gpu_index = faiss.index_cpu_to_gpu(self._gpu_res, 0, self.index)
+                self._gpu_key = key
+            except Exception as e:  # 例如 HNSW 没有GPU实现
+                print(f"索引复制到GPU失败: {str(e)}，改用CPU检索")
+                self.use_gpu = False
+                return self.index
+        return self._gpu_index
     
-    def query(self, query_embeddings: List[List[float]], n_results: int = 10) -> Dict[str, List]:
+    def _search_params(self, ef_search: Optional[int], nprobe: Optional[int]):
+        """单次查询的检索参数，覆盖构造时的 ef_search/nprobe，不修改索引本身（并发查询互不影响）"""
+        base = self._base_index()
+        if ef_search is not None and isinstance(base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = ef_search
+            return params
+        if nprobe is not None and isinstance(base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = min(nprobe, base.nlist)
+            return params
+        return None
+
+    def query(self, query_embeddings, n_results: int = 10,
+              ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> Dict[str, List]:
         """查询最相似的文档
         
         Args:
-            query_embeddings: 查询向量列表
+            query_embeddings: 查询向量矩阵 (np.ndarray 或 torch.Tensor) 或向量列表
             n_results: 返回结果数量
+            ef_search: 本次查询的 HNSW 候选队列长度，越大召回越高、越慢（仅 CPU 上的 HNSW 索引）
+            nprobe: 本次查询访问的 IVF 聚类数（仅 CPU 上的 IVF 索引）
             
         Returns:
-            包含documents、distances和ids的字典
+            包含documents、distances和ids的字典（新建索引的 distances 为内积相似度，越大越相似）
         """
         if not self.documents:
             return {"documents": [[]], "distances": [[]], "ids": [[]]}
         
-        # 转换为numpy数组
-        query_np = np.array(query_embeddings).astype('float32')
+        # 还有未训练的向量时先训练，保证所有文档都能被检索到
+        self._train_pending()
+
+        index = self._search_index()
+        if isinstance(query_embeddings, torch.Tensor):
+            if self.use_gpu and TORCH_SEARCH_AVAILABLE:
+                # GPU 索引直接检索设备上的张量，结果也是张量
+                query_np = query_embeddings.to(torch.float32).contiguous()
+            else:
+                query_np = query_embeddings.detach().to(torch.float32).cpu().numpy()
+        else:
+            # 转换为连续的 float32 矩阵（已经是时不复制）
+            query_np = np.ascontiguousarray(query_embeddings, dtype=np.float32)
+        if query_np.shape[-1] > self.dimension:
+            query_np = self._truncate_queries(query_np)
+        elif query_np.shape[-1] < self.dimension:
+            raise ValueError(f"查询向量维度 {query_np.shape[-1]} 小于索引维度 {self.dimension}，"
+                             f"请设置 CHUNKIT_EMBED_DIM={self.dimension} 或重建索引")
         
-        # 执行查询
-        distances, indices = self.index.search(query_np, min(n_results, len(self.documents)))
+        k = min(n_results, len(self.documents))
+        result = None
+        if self.binary_index is not None and len(self.documents) > k:
+            # 两阶段：二值索引取候选，主索引中的向量精确重打分
+            if isinstance(query_np, torch.Tensor):
+                query_np = query_np.detach().cpu().numpy()
+            if self._binary_dirty:
+                self._rebuild_binary_index()
+            result = self._binary_search(query_np, k)
+        if result is not None:
+            distances, indices = result
+        else:
+            # 执行查询；GPU 副本沿用构造时的检索参数
+            params = self._search_params(ef_search, nprobe) if index is self.index else None
+            if params is not None:
+                distances, indices = index.search(query_np, k, params=params)
+            else:
+                distances, indices = index.search(query_np, k)
         
         # 构建结果
         results = {
@@ -139,16 +562,55 @@ class FAISSVectorStore:
             query_docs = []
             query_ids = []
             
-            for idx in query_indices:
-                if idx >= 0 and idx < len(self.documents):  # 确保索引有效
-                    query_docs.append(self.documents[idx])
-                    query_ids.append(self.ids[idx])
+            for label in query_indices.tolist():
+                pos = self._positions.get(label)  # -1 或已删除的ID没有对应位置
+                if pos is not None:
+                    query_docs.append(self.documents[pos])
+                    query_ids.append(self.ids[pos])
             
             results["documents"].append(query_docs)
             results["ids"].append(query_ids)
         
         return results
     
+    def _binary_search(self, query_np: np.ndarray, k: int):
+        """二值索引按汉明距离取 rescore_k 个候选，取回这些候选的向量计算内积，返回前 k 个的 (distances, indices)
+
+        主索引不能取回向量时返回 None 并停用二值索引，调用方改用主索引检索
+        """
+        n_candidates = min(max(self.rescore_k, k), len(self.documents))
+        faiss.downcast_IndexBinary(self.binary_index.index).hnsw.efSearch = max(n_candidates, 16)
+        _, candidates = self.binary_index.search(self._binarize(query_np), n_candidates)
+
+        distances = np.full((len(query_np), k), -np.finfo(np.float32).max, dtype=np.float32)
+        indices = np.full((len(query_np), k), -1, dtype=np.int64)
+        for row, labels in enumerate(candidates):
+            labels = labels[labels >= 0]
+            if not len(labels):
+                continue
+            try:
+                vectors = self.index.reconstruct_batch(labels)
+            except RuntimeError as e:
+                print(f"主索引不支持取回向量: {str(e)}，停用二值索引第一阶段")
+                self.binary_index = None
+                return None
+            scores = vectors @ query_np[row]
+            top = np.argsort(-scores, kind="stable")[:k]
+            distances[row, :len(top)] = scores[top]
+            indices[row, :len(top)] = labels[top]
+        return distances, indices
+
+    def _truncate_queries(self, query_np):
+        """查询向量比索引维度长时（嵌入模型输出完整维度、索引按截断维度建立），
+        按 Matryoshka 方式取前 dimension 维并重新归一化"""
+        if isinstance(query_np, torch.Tensor):
+            return torch.nn.functional.normalize(query_np[:, :self.dimension], dim=1).contiguous()
+        # 必须显式复制：(1, D) 的切片本身就算 C 连续，ascontiguousarray 会返回视图，
+        # 原地归一化会改写调用方（可能是查询向量缓存里共享）的数组
+        query_np = np.array(query_np[:, :self.dimension], dtype=np.float32, order="C")
+        faiss.normalize_L2(query_np)
+        return query_np
+
     def count(self) -> int:
         """返回索引中的文档数量"""
         return len(self.documents)
@@ -2,8 +2,13 @@ from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, Generator
+from typing import Optional, Generator, AsyncGenerator
 import json
+try:
+    import orjson  # 可选：比 json/Pydantic 序列化快得多，直接输出 UTF-8 字节
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 from RAGlibrary import RAG
 from Intent_answer import InteractiveAgent  
 import uvicorn
@@ -39,17 +44,36 @@ class QueryRequest(BaseModel):
 
 # 添加流式响应数据模型
 class StreamChunk(BaseModel):
-    """流式响应数据块模型"""
+    """流式响应数据块模型（描述 /query 每个SSE事件的格式；热路径上直接序列化字典，不经过 Pydantic）"""
     delta: str
     finished: bool = False
 
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
+def _dumps(obj) -> bytes:
+    """序列化为紧凑的 UTF-8 JSON 字节"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def sse_event(obj) -> bytes:
+    """把一个对象封装成SSE事件；返回字节，StreamingResponse 不必再编码"""
+    return _SSE_PREFIX + _dumps(obj) + _SSE_SUFFIX
+
+_SSE_END = sse_event({"delta": "", "finished": True})
+
 @app.on_event("startup")
 async def startup_event():
     """应用启动时初始化系统"""
     global rag_instance, agent_instance
     try:
         rag_instance = RAG()
+        # 模型在启动时加载并常驻，所有请求复用同一份实例，不按请求加载
+        app.state.embedding_model, app.state.cross_encoder = rag_instance.load_models()
+        app.state.rag = rag_instance
         agent_instance = InteractiveAgent()  # 初始化智能体
+        app.state.agent = agent_instance
         print("RAG系统和智能体初始化成功")
     except Exception as e:
         print(f"系统初始化失败: {str(e)}")
@@ -93,11 +117,11 @@ async def query_with_intent_stream(request: IntentQueryRequest):
     if not request.query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空")
     
-    def generate_intent_stream() -> Generator[str, None, None]:
+    def generate_intent_stream() -> Generator[bytes, None, None]:
         """生成带意图信息的流式响应
         
         Yields:
-            str: SSE格式的流式数据，包含意图和内容信息
+            bytes: SSE格式的流式数据，包含意图和内容信息
         """
         try:
             response_generator = agent_instance.process_question_with_intent(
@@ -108,11 +132,11 @@ async def query_with_intent_stream(request: IntentQueryRequest):
             if request.stream:
                 # 流式模式
                 for chunk in response_generator:
-                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    yield sse_event(chunk)
             else:
                 # 非流式模式，直接返回完整结果
                 result = response_generator
-                yield f"data: {json.dumps(result, ensure_ascii=False)}\n\n"
+                yield sse_event(result)
                 
         except Exception as e:
             error_chunk = {
@@ -120,7 +144,7 @@ async def query_with_intent_stream(request: IntentQueryRequest):
                 "error": str(e),
                 "finished": True
             }
-            yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+            yield sse_event(error_chunk)
     
     return StreamingResponse(
         generate_intent_stream(),
@@ -160,26 +184,26 @@ async def query_rag_stream(request: QueryRequest):
     if not request.query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空")
     
-    def generate_stream() -> Generator[str, None, None]:
+    async def generate_stream() -> AsyncGenerator[bytes, None]:
         """生成流式响应
+
+        编码和检索在线程池中执行，大模型响应异步读取，不阻塞事件循环上的其他连接
         
         Yields:
-            str: SSE格式的流式数据
+            bytes: SSE格式的流式数据，格式见 StreamChunk
         """
         try:
-            for delta in rag_instance.call_RAG_stream(request.query):
-                chunk_data = StreamChunk(delta=delta, finished=False)
-                yield f"data: {chunk_data.json()}\n\n"
+            async for delta in rag_instance.acall_RAG_stream(request.query):
+                yield sse_event({"delta": delta, "finished": False})
             
-            end_chunk = StreamChunk(delta="", finished=True)
-            yield f"data: {end_chunk.json()}\n\n"
+            yield _SSE_END
             
         except Exception as e:
             error_chunk = {
                 "error": str(e),
                 "finished": True
             }
-            yield f"data: {json.dumps(error_chunk)}\n\n"
+            yield sse_event(error_chunk)
     
     return StreamingResponse(
         generate_stream(),
@@ -201,14 +225,14 @@ async def simple_query_stream(query: str):
     if not query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空")
     
-    def generate_simple_stream() -> Generator[str, None, None]:
+    async def generate_simple_stream() -> AsyncGenerator[str, None]:
         """生成简化的流式响应
         
         Yields:
             str: 纯文本流式数据
         """
         try:
-            for delta in rag_instance.call_RAG_stream(query):
+            async for delta in rag_instance.acall_RAG_stream(query):
                 yield delta
         except Exception as e:
             yield f"\n\n[错误]: {str(e)}"
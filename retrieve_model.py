@@ -1,38 +1,320 @@
+from embedding_loader import encode_float32, load_embedding_model, load_cross_encoder, CROSS_ENCODER_PATH
+try:
+    import numba  # 可选：候选较多时用 JIT 编译的堆选择前 k 个
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 from sentence_transformers import SentenceTransformer
 from sentence_transformers import CrossEncoder
 import torch
 import numpy as np
 from typing import List, Tuple, Optional
-from faiss_store import FAISSVectorStore  # 引入FAISS向量存储
+from faiss_store import FAISSVectorStore, TORCH_SEARCH_AVAILABLE  # 引入FAISS向量存储
+import threading
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from transformers import PreTrainedTokenizerBase
 
-local_model_path = "./cross-encoder-model"
+local_model_path = CROSS_ENCODER_PATH
+embedding_model_path = "./Qwen3-Embedding-0.6B"
 collection_name = "document_embeddings"
 
+# 调用方未传入模型时使用的进程内单例：首次使用时直接加载到目标设备，之后每次查询复用
+_embed_model = None
+_cross_encoder = None
+_model_lock = threading.Lock()
+_search_executor = None
+
+# 交叉编码器打分缓存：每个模型一份 LRU，键为 (查询哈希, 片段哈希)，热门片段在不同查询/会话间反复出现时免去重复前向计算
+SCORE_CACHE_SIZE = 100_000
+_score_caches = weakref.WeakKeyDictionary()
+_score_cache_lock = threading.Lock()
+
+# 片段分词缓存：每个交叉编码器一份 LRU，键为片段哈希，知识库片段是静态的，只在第一次出现时分词
+TOKEN_CACHE_SIZE = 50_000
+_token_caches = weakref.WeakKeyDictionary()
+_token_cache_lock = threading.Lock()
+
+def _get_embed_model() -> SentenceTransformer:
+    global _embed_model
+    if _embed_model is None:
+        with _model_lock:
+            if _embed_model is None:
+                _embed_model = load_embedding_model(embedding_model_path)
+    return _embed_model
+
+def _get_cross_encoder() -> CrossEncoder:
+    global _cross_encoder
+    if _cross_encoder is None:
+        with _model_lock:
+            if _cross_encoder is None:
+                _cross_encoder = load_cross_encoder(local_model_path)
+    return _cross_encoder
+
+def get_models() -> Tuple[SentenceTransformer, CrossEncoder]:
+    """返回（必要时先加载）模块内共享的嵌入模型和交叉编码器
+
+    服务启动时调用一次即可把模型常驻内存，之后的检索调用不传模型参数时也使用这两个实例
+    """
+    return _get_embed_model(), _get_cross_encoder()
+
+@lru_cache(maxsize=1024)
+def _encode_query_cached(user_query: str) -> np.ndarray:
+    """用共享嵌入模型编码单个查询，结果按查询文本缓存（重复提交同一问题时不再编码）
+
+    返回的矩阵被多次调用共享，调用方不要原地修改
+    """
+    return encode_float32(_get_embed_model(), [user_query], prompt_name="query", normalize_embeddings=True)
+
+# 每个查询从 FAISS 取出、交给交叉编码器重排的候选数上限（top_k 超过时截断）；
+# 足够容纳 top_k=200 的重排池（与二值索引第一阶段的 rescore_k 默认值一致）
+MAX_CANDIDATES = 256
+
+# 候选数超过该值且装有 numba 时用堆选择，否则用 np.argpartition（top_k 调大到 64 以上时生效）
+NUMBA_TOPK_MIN = 64
+
+if NUMBA_AVAILABLE:
+    @numba.njit(cache=True)
+    def _topk_heap(scores, k):
+        """固定大小的小顶堆扫描一遍分数，返回前 k 个的下标（无序）；cache=True 把编译结果缓存到磁盘"""
+        heap_vals = np.empty(k, dtype=scores.dtype)
+        heap_idx = np.empty(k, dtype=np.int64)
+        for i in range(k):
+            # 前 k 个依次上浮建堆
+            heap_vals[i] = scores[i]
+            heap_idx[i] = i
+            child = i
+            while child > 0:
+                parent = (child - 1) // 2
+                if heap_vals[parent] <= heap_vals[child]:
+                    break
+                heap_vals[parent], heap_vals[child] = heap_vals[child], heap_vals[parent]
+                heap_idx[parent], heap_idx[child] = heap_idx[child], heap_idx[parent]
+                child = parent
+        for i in range(k, scores.shape[0]):
+            if scores[i] <= heap_vals[0]:
+                continue
+            # 替换堆顶后下沉
+            heap_vals[0] = scores[i]
+            heap_idx[0] = i
+            parent = 0
+            while True:
+                smallest = parent
+                left = 2 * parent + 1
+                right = left + 1
+                if left < k and heap_vals[left] < heap_vals[smallest]:
+                    smallest = left
+                if right < k and heap_vals[right] < heap_vals[smallest]:
+                    smallest = right
+                if smallest == parent:
+                    break
+                heap_vals[parent], heap_vals[smallest] = heap_vals[smallest], heap_vals[parent]
+                heap_idx[parent], heap_idx[smallest] = heap_idx[smallest], heap_idx[parent]
+                parent = smallest
+        return heap_idx
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """分数最高的 k 个下标，按分数降序：先 O(n) 选出前 k 个，只对这 k 个排序
+
+    候选较多（如 top_k=200 的重排池）且装有 numba 时用 JIT 编译的堆选择，只扫描一遍数组；
+    首次调用会触发编译（之后从磁盘缓存加载）
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    if NUMBA_AVAILABLE and len(scores) > NUMBA_TOPK_MIN:
+        idx = np.sort(_topk_heap(np.ascontiguousarray(scores), k))  # 先按下标排好，下面的稳定排序对同分者按下标先后
+    else:
+        idx = np.argpartition(scores, -k)[-k:]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+def _text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+def rerank_scores(cross_encoder: CrossEncoder, pairs: List[Tuple[str, str]],
+                  batch_size: int = 32, use_cache: bool = True) -> np.ndarray:
+    """交叉编码器对 (查询, 片段) 对打分，返回与 pairs 顺序一致的分数
+
+    use_cache: 先查打分缓存，只对未缓存的对调用模型，新算出的分数写回缓存
+    """
+    if not use_cache or not pairs:
+        return _predict_scores(cross_encoder, pairs, batch_size)
+
+    query_hashes = {}
+    keys = []
+    for q, c in pairs:
+        qh = query_hashes.get(q)
+        if qh is None:
+            qh = query_hashes[q] = _text_hash(q)
+        keys.append((qh, _text_hash(c)))
+
+    scores = np.empty(len(pairs), dtype=np.float32)
+    misses = []
+    with _score_cache_lock:
+        cache = _score_caches.get(cross_encoder)
+        if cache is None:
+            cache = _score_caches[cross_encoder] = OrderedDict()
+        for i, key in enumerate(keys):
+            score = cache.get(key)
+            if score is None:
+                misses.append(i)
+            else:
+                cache.move_to_end(key)
+                scores[i] = score
+    if not misses:
+        return scores
+
+    new_scores = _predict_scores(cross_encoder, [pairs[i] for i in misses], batch_size)
+    scores[misses] = new_scores
+    with _score_cache_lock:
+        for i, score in zip(misses, new_scores.tolist()):
+            cache[keys[i]] = score
+            cache.move_to_end(keys[i])
+        while len(cache) > SCORE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return scores
+
+def _supports_pretokenized(cross_encoder: CrossEncoder) -> bool:
+    """能否跳过 predict 自己拼接 token：PyTorch 后端、单输出打分，且分词器在 Python 层实现了特殊符号的拼接"""
+    tokenizer = getattr(cross_encoder, "tokenizer", None)
+    model = getattr(cross_encoder, "model", None)
+    return (
+        isinstance(model, torch.nn.Module)
+        and getattr(getattr(model, "config", None), "num_labels", None) == 1
+        and isinstance(tokenizer, PreTrainedTokenizerBase)
+        and type(tokenizer).build_inputs_with_special_tokens
+            is not PreTrainedTokenizerBase.build_inputs_with_special_tokens
+    )
+
+def _chunk_token_ids(cross_encoder: CrossEncoder, chunks: List[str]) -> List[List[int]]:
+    """片段的 token ID（不含特殊符号），未缓存的片段一次批量分词后写入缓存"""
+    keys = [_text_hash(c) for c in chunks]
+    ids = [None] * len(chunks)
+    with _token_cache_lock:
+        cache = _token_caches.get(cross_encoder)
+        if cache is None:
+            cache = _token_caches[cross_encoder] = OrderedDict()
+        for i, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached is not None:
+                cache.move_to_end(key)
+                ids[i] = cached
+    misses = [i for i, cached in enumerate(ids) if cached is None]
+    if misses:
+        encoded = cross_encoder.tokenizer([chunks[i] for i in misses], add_special_tokens=False)["input_ids"]
+        with _token_cache_lock:
+            for i, token_ids in zip(misses, encoded):
+                ids[i] = cache[keys[i]] = token_ids
+                cache.move_to_end(keys[i])
+            while len(cache) > TOKEN_CACHE_SIZE:
+                cache.popitem(last=False)
+    return ids
+
+def _predict_pretokenized(cross_encoder: CrossEncoder, pairs: List[Tuple[str, str]],
+                          batch_size: int) -> np.ndarray:
+    """用缓存的片段 token 打分：每个查询只分词一次，与片段 token 拼接、截断（同 predict 的 longest_first）后
+    按真实 token 长度降序分批，直接调用底层模型并套用与 predict 相同的激活函数"""
+    tokenizer = cross_encoder.tokenizer
+    model = cross_encoder.model
+    max_length = getattr(cross_encoder, "max_length", None) or tokenizer.model_max_length
+    activation = getattr(cross_encoder, "activation_fn", None) or getattr(
+        cross_encoder, "default_activation_function", None)
+
+    queries = list(dict.fromkeys(q for q, _ in pairs))
+    query_ids = dict(zip(queries, tokenizer(queries, add_special_tokens=False)["input_ids"]))
+    chunk_ids = _chunk_token_ids(cross_encoder, [c for _, c in pairs])
+    features = [
+        tokenizer.prepare_for_model(query_ids[q], c_ids, truncation="longest_first", max_length=max_length)
+        for (q, _), c_ids in zip(pairs, chunk_ids)
+    ]
+    lengths = np.fromiter((len(f["input_ids"]) for f in features), dtype=np.int64, count=len(features))
+    order = np.argsort(-lengths, kind="stable")
+
+    scores = np.empty(len(pairs), dtype=np.float32)
+    on_cuda = str(model.device).startswith("cuda")
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=on_cuda):
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            batch = tokenizer.pad([features[i] for i in idx], return_tensors="pt").to(model.device)
+            logits = model(**batch).logits
+            if activation is not None:
+                logits = activation(logits)
+            scores[idx] = logits.float().reshape(len(idx)).cpu().numpy()
+    return scores
+
+def _predict_scores(cross_encoder: CrossEncoder, pairs: List[Tuple[str, str]],
+                    batch_size: int) -> np.ndarray:
+    """调用交叉编码器打分
+
+    条件允许时走预分词路径（见 _predict_pretokenized）；否则调用 predict：
+    先按文本长度降序排列再分批，同一批内长度相近，动态 padding 的浪费最少；
+    在 CUDA 上套 FP16 autocast，打完分按逆序映射回原顺序
+    """
+    if _supports_pretokenized(cross_encoder):
+        return _predict_pretokenized(cross_encoder, pairs, batch_size)
+
+    lengths = np.fromiter((len(q) + len(c) for q, c in pairs), dtype=np.int64, count=len(pairs))
+    order = np.argsort(-lengths, kind="stable")
+    sorted_pairs = [pairs[i] for i in order]
+
+    on_cuda = str(cross_encoder.model.device).startswith("cuda")
+    with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=on_cuda):
+        sorted_scores = cross_encoder.predict(sorted_pairs, batch_size=batch_size, convert_to_numpy=True)
+
+    scores = np.empty(len(pairs), dtype=np.float32)
+    scores[order] = np.asarray(sorted_scores, dtype=np.float32).reshape(len(pairs))
+    return scores
+
 def retrieve_relevant_chunks(user_query: str, vector_store: FAISSVectorStore, 
                            top_k: int = 15, final_k: int = 5, 
                            embedding_model: Optional[SentenceTransformer] = None, 
-                           cross_encoder1: Optional[CrossEncoder] = None) -> List[str]:
-    """使用FAISS检索相关文档片段的函数，优化了性能和错误处理"""
-    if embedding_model is None or cross_encoder1 is None:
-        raise ValueError("embedding_model和cross_encoder1参数不能为None")
-    
-    model = embedding_model
-    cross_encoder = cross_encoder1
+                           cross_encoder1: Optional[CrossEncoder] = None,
+                           query_embedding: Optional[np.ndarray] = None,
+                           ef_search: Optional[int] = None,
+                           nprobe: Optional[int] = None) -> List[str]:
+    """使用FAISS检索相关文档片段的函数，优化了性能和错误处理
+
+    embedding_model / cross_encoder1: 未传入时使用模块内只加载一次的共享模型
+    query_embedding: 调用方已算好的归一化查询向量（如语义缓存查找时算出的），提供时不再重复编码
+    ef_search / nprobe: 近似索引（HNSW / IVF）本次检索的召回与速度权衡，不设置时使用索引的默认值
+    """
+    model = embedding_model if embedding_model is not None else _get_embed_model()
+    cross_encoder = cross_encoder1 if cross_encoder1 is not None else _get_cross_encoder()
     
     try:
         # 优化：生成查询向量，使用更高效的编码方式
-        with torch.no_grad():  # 减少内存使用
-            query_embedding = model.encode(
-                user_query, 
+        if query_embedding is None and vector_store.use_gpu and TORCH_SEARCH_AVAILABLE:
+            # GPU 索引：归一化后的查询向量留在显存中直接检索，不拷回主机
+            with torch.inference_mode():
+                query_embedding = model.encode(
+                    [user_query],
+                    prompt_name="query",
+                    convert_to_tensor=True,
+                    normalize_embeddings=True
+                )
+        elif query_embedding is None and embedding_model is None:
+            query_embedding = _encode_query_cached(user_query)
+        elif query_embedding is None:
+            query_embedding = encode_float32(  # 直接得到连续的 float32 矩阵
+                model,
+                [user_query],
                 prompt_name="query",
-                convert_to_tensor=False,  # 直接返回numpy数组
                 normalize_embeddings=True  # 标准化嵌入向量
-            ).tolist()
+            )
+        if not isinstance(query_embedding, torch.Tensor):
+            query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
 
         # 从FAISS向量存储检索
         results = vector_store.query(
-            query_embeddings=[query_embedding],
-            n_results=min(top_k, 50)  # 限制最大检索数量
+            query_embeddings=query_embedding,
+            n_results=min(top_k, MAX_CANDIDATES),  # 限制最大检索数量
+            ef_search=ef_search,
+            nprobe=nprobe
         )
         
         if not results["documents"][0]:
@@ -48,12 +330,10 @@ def retrieve_relevant_chunks(user_query: str, vector_store: FAISSVectorStore,
         # 使用交叉编码器重新排序 - 批量处理
         pairs = [(user_query, chunk) for chunk in documents]
         
-        with torch.no_grad():  # 减少内存使用
-            scores = cross_encoder.predict(pairs, batch_size=32)  # 批量预测
+        scores_array = rerank_scores(cross_encoder, pairs, batch_size=32)  # 一次批量打分
         
         # 优化：使用numpy进行更快的排序
-        scores_array = np.array(scores)
-        top_indices = np.argsort(scores_array)[::-1][:final_k]  # 获取top_k索引
+        top_indices = top_k_indices(scores_array, final_k)  # 获取top_k索引
         
         return [documents[i] for i in top_indices]
         
@@ -61,42 +341,125 @@ def retrieve_relevant_chunks(user_query: str, vector_store: FAISSVectorStore,
         print(f"检索过程中发生错误: {e}")
         return []
 
+def _get_search_executor() -> ThreadPoolExecutor:
+    """批量检索时在后台执行 FAISS 检索的线程池（进程内共享）"""
+    global _search_executor
+    if _search_executor is None:
+        with _model_lock:
+            if _search_executor is None:
+                _search_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="faiss-search")
+    return _search_executor
+
+def _rerank_group(queries: List[str], documents_per_query: List[List[str]], final_k: int,
+                  cross_encoder: CrossEncoder, rerank_batch_size: int) -> List[List[str]]:
+    """对一组查询的候选片段做一次批量重排，候选不超过 final_k 的查询原样返回"""
+    # 需要重排的查询，把它们的 (查询, 片段) 对拼成一批
+    pairs = []
+    spans = []
+    for query, documents in zip(queries, documents_per_query):
+        if len(documents) > final_k:
+            spans.append((len(pairs), len(pairs) + len(documents)))
+            pairs.extend((query, chunk) for chunk in documents)
+        else:
+            spans.append(None)
+
+    scores_array = None
+    if pairs:
+        scores_array = rerank_scores(cross_encoder, pairs, batch_size=rerank_batch_size)
+
+    output = []
+    for documents, span in zip(documents_per_query, spans):
+        if span is None:
+            output.append(documents)
+            continue
+        top_indices = top_k_indices(scores_array[span[0]:span[1]], final_k)
+        output.append([documents[i] for i in top_indices])
+    return output
+
 def batch_retrieve_relevant_chunks(queries: List[str], vector_store: FAISSVectorStore,
                                   top_k: int = 15, final_k: int = 5,
                                   embedding_model: Optional[SentenceTransformer] = None,
-                                  cross_encoder1: Optional[CrossEncoder] = None) -> List[List[str]]:
-    """批量检索多个查询的相关文档片段"""
-    if embedding_model is None or cross_encoder1 is None:
-        raise ValueError("embedding_model和cross_encoder1参数不能为None")
-    
-    results = []
-    for query in queries:
-        chunks = retrieve_relevant_chunks(
-            query, vector_store, top_k, final_k, 
-            embedding_model, cross_encoder1
-        )
-        results.append(chunks)
-    
-    return results
+                                  cross_encoder1: Optional[CrossEncoder] = None,
+                                  query_embeddings: Optional[np.ndarray] = None,
+                                  batch_size: int = 32,
+                                  ef_search: Optional[int] = None,
+                                  nprobe: Optional[int] = None,
+                                  rerank_batch_size: int = 64,
+                                  overlap_groups: int = 2) -> List[List[str]]:
+    """批量检索多个查询的相关文档片段
+
+    所有查询一次性编码；按 overlap_groups 分组检索，每组的 (查询, 片段) 对由交叉编码器做一次批量打分
+    query_embeddings: 调用方已算好的归一化查询向量矩阵，shape 为 (len(queries), dim)
+    ef_search / nprobe: 同 retrieve_relevant_chunks
+    batch_size: 查询编码的批次大小
+    rerank_batch_size: 交叉编码器的批次大小；所有查询的候选对拼在一起，数量是查询数 × top_k，批次可以更大
+    overlap_groups: 把查询分成几组，组间 FAISS 检索与重排流水执行；1 表示一次检索全部查询
+    """
+    if not queries:
+        return []
+    if embedding_model is None:
+        embedding_model = _get_embed_model()
+    if cross_encoder1 is None:
+        cross_encoder1 = _get_cross_encoder()
+
+    try:
+        if query_embeddings is None:
+            query_embeddings = encode_float32(
+                embedding_model,
+                queries,
+                prompt_name="query",
+                batch_size=batch_size,
+                normalize_embeddings=True
+            )
+
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+
+        def search(lo, hi):
+            results = vector_store.query(
+                query_embeddings=query_embeddings[lo:hi],
+                n_results=min(top_k, MAX_CANDIDATES),
+                ef_search=ef_search,
+                nprobe=nprobe
+            )
+            # 索引为空时只返回一行空结果
+            documents_per_query = results["documents"]
+            if len(documents_per_query) != hi - lo:
+                return [[] for _ in range(hi - lo)]
+            return documents_per_query
+
+        # 查询分组：后一组的 FAISS 检索在后台线程进行，与前一组的重排重叠
+        # （FAISS 和 PyTorch 在计算时都释放 GIL）；查询太少时不分组
+        if overlap_groups > 1 and len(queries) >= 2 * overlap_groups:
+            group = math.ceil(len(queries) / overlap_groups)
+        else:
+            group = len(queries)
+        bounds = [(lo, min(lo + group, len(queries))) for lo in range(0, len(queries), group)]
+
+        output = []
+        if len(bounds) == 1:
+            output = _rerank_group(queries, search(0, len(queries)), final_k, cross_encoder1, rerank_batch_size)
+        else:
+            pending = _get_search_executor().submit(search, *bounds[0])
+            for i, (lo, hi) in enumerate(bounds):
+                documents_per_query = pending.result()
+                if i + 1 < len(bounds):
+                    pending = _get_search_executor().submit(search, *bounds[i + 1])
+                output.extend(_rerank_group(queries[lo:hi], documents_per_query, final_k,
+                                            cross_encoder1, rerank_batch_size))
+        return output
+
+    except Exception as e:
+        print(f"批量检索过程中发生错误: {e}")
+        return [[] for _ in queries]
 
 # 使用示例
 if __name__ == "__main__":
-    # 初始化模型
-    model = SentenceTransformer(
-        "./Qwen3-Embedding-0.6B",
-        tokenizer_kwargs={"padding_side": "left"},
-        trust_remote_code=True,
-        device="cuda" if torch.cuda.is_available() else "cpu"
-    )
-    cross_encoder = CrossEncoder(local_model_path)
-    
+    # 模型在首次检索时加载，之后的查询复用
     user_query = input("请输入你的问题: ")
     vector_store = FAISSVectorStore(index_path="./faiss_index", collection_name=collection_name)
     relevant_chunks = retrieve_relevant_chunks(
         user_query=user_query,
-        vector_store=vector_store,
-        embedding_model=model,
-        cross_encoder1=cross_encoder
+        vector_store=vector_store
     )
     
     print(f"检索到 {len(relevant_chunks)} 个相关文档片段:")
@@ -1,6 +1,6 @@
 from __future__ import annotations
 import re
-from typing import Any, Literal, Optional, Union
+from typing import Any, Callable, Literal, Optional, Union
 
 from langchain_text_splitters.base import Language, TextSplitter
 
@@ -92,12 +92,18 @@ class RecursiveCharacterTextSplitter(TextSplitter):
         separators: Optional[list[str]] = None,
         keep_separator: Union[bool, Literal["start", "end"]] = True,  # noqa: FBT001,FBT002
         is_separator_regex: bool = False,  # noqa: FBT001,FBT002
+        batch_length_function: Optional[Callable[[list[str]], list[int]]] = None,
         **kwargs: Any,
     ) -> None:
-        """Create a new TextSplitter."""
+        """Create a new TextSplitter.
+
+        batch_length_function: optional function measuring a whole list of splits
+        in one call (e.g. a batched tokenizer); must agree with length_function.
+        """
         super().__init__(keep_separator=keep_separator,** kwargs)
         self._separators = separators or ["\n\n", "\n", " ", ""]
         self._is_separator_regex = is_separator_regex
+        self._batch_length_function = batch_length_function
 
     def _split_text(self, text: str, separators: list[str]) -> list[str]:
         """Split incoming text and return chunks."""
@@ -123,8 +129,12 @@ class RecursiveCharacterTextSplitter(TextSplitter):
         # Now go merging things, recursively splitting longer texts.
         _good_splits = []
         _separator = "" if self._keep_separator else separator
-        for s in splits:
-            if self._length_function(s) < self._chunk_size:
+        if self._batch_length_function is not None:
+            lengths = self._batch_length_function(splits)
+        else:
+            lengths = map(self._length_function, splits)
+        for s, length in zip(splits, lengths):
+            if length < self._chunk_size:
                 _good_splits.append(s)
             else:
                 if _good_splits:
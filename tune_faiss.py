@@ -0,0 +1,149 @@
+"""离线调优 FAISS 检索参数（HNSW 的 efSearch / IVF 的 nprobe）
+
+在已建好的索引上用 Optuna 搜索满足 recall@k >= 目标值时查询耗时最短的参数，
+结果写入索引目录下的 {collection}.search.json，FAISSVectorStore 加载索引时自动读取。
+M、efConstruction、nlist 等建索引参数需要重建索引才能改变，不在这里调。
+
+召回率以精确检索为参照：HNSW 索引取回全部向量做暴力内积检索，IVF 索引访问全部聚类（nprobe=nlist）。
+调参查询应是不在库中的真实问题（--queries）；不提供时从已入库的片段中抽样，每个查询的最近邻就是它自己，
+召回率会偏高，只适合粗调。
+
+用法: python tune_faiss.py --index_path ./faiss_index/campus --collection campus_docs --queries queries.txt
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+import faiss
+
+from faiss_store import FAISSVectorStore
+from embedding_loader import load_embedding_model, encode_float32
+
+try:
+    import optuna  # 只有调参脚本需要：pip install optuna
+    OPTUNA_AVAILABLE = True
+except ImportError:
+    OPTUNA_AVAILABLE = False
+
+
+def _recall(found: np.ndarray, truth: np.ndarray) -> float:
+    """found 与 truth 每行的交集占比的平均值（-1 为空位，不计入）"""
+    hits = 0
+    total = 0
+    for row, ref in zip(found, truth):
+        ref = set(ref[ref >= 0].tolist())
+        hits += len(ref.intersection(row.tolist()))
+        total += len(ref)
+    return hits / max(total, 1)
+
+
+def _exact_search(store: FAISSVectorStore, x: np.ndarray, k: int, batch: int = 65536) -> np.ndarray:
+    """从索引中取回全部向量，用 IndexFlatIP 暴力检索，返回各查询前 k 个的向量ID"""
+    labels = np.asarray(store.labels, dtype=np.int64)
+    flat = faiss.IndexFlatIP(store.dimension)
+    for start in range(0, len(labels), batch):
+        flat.add(np.ascontiguousarray(store.index.reconstruct_batch(labels[start:start + batch]), dtype=np.float32))
+    _, positions = flat.search(x, k)
+    return np.where(positions >= 0, labels[np.maximum(positions, 0)], -1)
+
+
+def tune_search_params(index_path: str, collection_name: str, queries=None, k: int = 15,
+                       target_recall: float = 0.95, n_trials: int = 40, n_queries: int = 200,
+                       repeats: int = 3) -> dict:
+    """调优并保存检索参数，返回写入文件的字典
+
+    queries: 调参用的查询文本，应与库中片段不同（如线上的真实问题）；不提供时从已入库的片段中
+        随机抽取 n_queries 条代替，此时召回率偏高
+    k: 计算 recall@k 的 k，与检索时的 top_k 一致
+    repeats: 每组参数重复计时的次数，取最小值以减少抖动
+    """
+    if not OPTUNA_AVAILABLE:
+        raise ImportError("调参需要安装 optuna: pip install optuna")
+
+    store = FAISSVectorStore(index_path=index_path, collection_name=collection_name, mmap=True)
+    if store.count() == 0:
+        raise ValueError("索引为空，请先建立索引")
+    base = store._base_index()
+    if isinstance(base, faiss.IndexHNSW):
+        name, low, high = "ef_search", max(k, 16), 512
+    elif isinstance(base, faiss.IndexIVF):
+        name, low, high = "nprobe", 1, base.nlist
+    else:
+        raise ValueError("只有 HNSW 和 IVF 类索引有可调的检索参数")
+
+    if not queries:
+        print("未提供调参查询，从已入库的片段中抽样代替：查询与库中片段相同，召回率会偏高，建议用 --queries 提供真实问题")
+        queries = random.sample(store.documents, min(n_queries, store.count()))
+    model = load_embedding_model()
+    x = encode_float32(model, list(queries), prompt_name="query", normalize_embeddings=True)
+    if x.shape[1] > store.dimension:
+        x = store._truncate_queries(x)
+    k = min(k, store.count())
+
+    def run(value: int):
+        """按给定参数检索全部查询，返回 (最短耗时毫秒/查询, 结果向量ID)"""
+        params = store._search_params(value if name == "ef_search" else None,
+                                      value if name == "nprobe" else None)
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            _, labels = store.index.search(x, k, params=params)
+            best = min(best, time.perf_counter() - start)
+        return best * 1000 / len(x), labels
+
+    # 参照结果：IVF 访问全部聚类即为对量化后向量的穷举；HNSW 取回全部向量做精确的暴力检索
+    if name == "nprobe":
+        _, truth = run(high)
+    else:
+        truth = _exact_search(store, x, k)
+
+    def objective(trial):
+        value = trial.suggest_int(name, low, high, log=True)
+        latency, labels = run(value)
+        recall = _recall(labels, truth)
+        trial.set_user_attr("recall", recall)
+        if recall < target_recall:
+            raise optuna.TrialPruned()
+        return latency
+
+    study = optuna.create_study(direction="minimize")
+    study.enqueue_trial({name: getattr(store, name)})  # 先测当前参数作为基准
+    study.optimize(objective, n_trials=n_trials)
+
+    feasible = [t for t in study.trials if t.state == optuna.trial.TrialState.COMPLETE]
+    if feasible:
+        best = study.best_trial
+        value, latency, recall = best.params[name], best.value, best.user_attrs["recall"]
+    else:
+        value = high
+        latency, labels = run(high)
+        recall = _recall(labels, truth)
+        print(f"没有参数达到 recall@{k} >= {target_recall}，使用上限 {name}={high}")
+
+    result = {name: value, "recall": round(recall, 4), "latency_ms": round(latency, 4), "k": k,
+              "count": store.count()}
+    with open(store.search_params_file, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"调参完成: {result}，已写入 {store.search_params_file}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线调优 FAISS 检索参数")
+    parser.add_argument("--index_path", default="./faiss_index")
+    parser.add_argument("--collection", default="document_embeddings")
+    parser.add_argument("--queries", default=None,
+                        help="调参用的查询文件，每行一个查询（应为不在库中的真实问题，不提供时用库中片段代替，召回率偏高）")
+    parser.add_argument("--k", type=int, default=15)
+    parser.add_argument("--target_recall", type=float, default=0.95)
+    parser.add_argument("--n_trials", type=int, default=40)
+    args = parser.parse_args()
+
+    queries = None
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+    tune_search_params(args.index_path, args.collection, queries=queries, k=args.k,
+                       target_recall=args.target_recall, n_trials=args.n_trials)